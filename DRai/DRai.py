@@ -1,15 +1,42 @@
 import os
-import json
-import time
+import itertools
 import pandas as pd
 import sys
 from dotenv import load_dotenv
-from google import genai
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.batch_runner import TokenBucket, run_batches
+from common.response_cache import ResponseCache
+from common.checkpoint import BatchCheckpoint
+from common.batching import AdaptiveBatchSizer, code_with_split, estimate_tokens, iter_chunk_batches
+from common.json_mode import json_array_instructions
+from common.llm_client import get_genai_client, get_llm_client
+from common.transcript_coding import TranscriptCoder, select_dialogue_column
 
 # 載入 .env 中的 GEMINI_API_KEY
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# 同時送出的批次數與每秒請求上限（依 API 配額調整）
+MAX_WORKERS = int(os.getenv("DRAI_MAX_WORKERS", "4"))
+REQUESTS_PER_SECOND = float(os.getenv("DRAI_REQUESTS_PER_SECOND", "1"))
+
+# 回應快取：相同模型 + 提示 + ITEMS + 逐字稿，重跑時不再呼叫 API
+MODEL_NAME = "gemini-2.0-flash"
+CACHE_PATH = os.getenv("DRAI_CACHE_PATH", ".drai_cache.sqlite")
+CACHE_MAX_ENTRIES = int(os.getenv("DRAI_CACHE_MAX_ENTRIES", "200000"))
+
+# 依 token 預算打包批次：每批輸入 token 上限與最多筆數（錯位時會自動縮小）
+TOKEN_BUDGET = int(os.getenv("DRAI_TOKEN_BUDGET", "8000"))
+MAX_BATCH_ROWS = int(os.getenv("DRAI_MAX_BATCH_ROWS", "30"))
+
+# --stream 模式下每次讀入的列數
+CHUNK_SIZE = int(os.getenv("DRAI_CHUNK_SIZE", "1000"))
+
+# 回覆格式："delimiter"（以 ----- 分隔多段 JSON）或 "json"（單一 JSON 陣列，逐筆帶 index）
+RESPONSE_MODE = os.getenv("DRAI_RESPONSE_MODE", "delimiter")
+ALLOWED_VALUES = ("1", "")
+
 OUTPUT_FIELDS = ["Rules", "History", "Fun Fact", "Origin"]
 
 ITEMS = [
@@ -24,53 +51,9 @@ ITEMS = [
     "History and Origin",      # 是否提及運動的歷史或發源地
 ]
 
-def parse_response(response_text):
-    """
-    嘗試解析 Gemini API 回傳的 JSON 格式結果。
-    如果回傳內容被 markdown 的反引號包圍，則先移除這些標記。
-    若解析失敗，則回傳所有項目皆為空的字典。
-    """
-    cleaned = response_text.strip()
-    # 如果回傳內容以三個反引號開始，則移除第一行和最後一行
-    if cleaned.startswith("```"):
-        lines = cleaned.splitlines()
-        if lines[0].startswith("```"):
-            lines = lines[1:]
-        if lines and lines[-1].strip() == "```":
-            lines = lines[:-1]
-        cleaned = "\n".join(lines).strip()
-    
-    try:
-        result = json.loads(cleaned)
-        for item in ITEMS:
-            if item not in result:
-                result[item] = ""
-        return result
-    except Exception as e:
-        print(f"解析 JSON 失敗：{e}")
-        print("原始回傳內容：", response_text)
-        return {item: "" for item in ITEMS}
-
-def select_dialogue_column(chunk: pd.DataFrame) -> str:
-    """
-    根據 CSV 欄位內容自動選取存放逐字稿的欄位。
-    優先檢查常見欄位名稱："text", "utterance", "content", "dialogue"
-    若都不存在，則回傳第一個欄位。
-    """
-    preferred = ["text", "utterance", "content", "dialogue", "Dialogue"]
-    for col in preferred:
-        if col in chunk.columns:
-            return col
-    print("CSV 欄位：", list(chunk.columns))
-    return chunk.columns[0]
-
-def process_batch_dialogue(client, dialogues: list, delimiter="-----"):
-    """
-    將多筆逐字稿合併成一個批次請求。
-    提示中要求模型對每筆逐字稿產生 JSON 格式回覆，
-    並以指定的 delimiter 分隔各筆結果。
-    """
-    prompt = (
+def build_prompt(delimiter="-----"):
+    """批次編碼的提示模板（不含逐字稿內容），同時作為快取 key 的一部分"""
+    return (
         "你是一位運動專家，請根據以下編碼規則評估對方是否了解運動與其相關規則，\n"
         + "\n".join(ITEMS) +
         "\n\n請依據評估結果，對每個項目：若觸及則標記為 1，否則留空。"
@@ -82,69 +65,79 @@ def process_batch_dialogue(client, dialogues: list, delimiter="-----"):
         f"{delimiter}\n"
         "{{...}}\n```"
     )
-    batch_text = f"\n{delimiter}\n".join(dialogues)
-    content = prompt + "\n\n" + batch_text
 
-    try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=content
-        )
-    except:
-        print(f"API 呼叫失敗：")
-        return [{item: "" for item in ITEMS} for _ in dialogues]
-    
-    print("批次 API 回傳內容：", response.text)
-    parts = response.text.split(delimiter)
-    results = []
-    for part in parts:
-        part = part.strip()
-        if part:
-            results.append(parse_response(part))
-    # 若結果數量多於原始筆數，僅取前面對應筆數；若不足則補足空結果
-    if len(results) > len(dialogues):
-        results = results[:len(dialogues)]
-    elif len(results) < len(dialogues):
-        results.extend([{item: "" for item in ITEMS}] * (len(dialogues) - len(results)))
-    return results
+def build_json_prompt():
+    """JSON 陣列模式的提示模板"""
+    return (
+        "你是一位運動專家，請根據以下編碼規則評估對方是否了解運動與其相關規則，\n"
+        + "\n".join(ITEMS) +
+        "\n\n請依據評估結果，對每個項目：若觸及則標記為 \"1\"，否則為空字串 \"\"。"
+        + json_array_instructions(ITEMS, ALLOWED_VALUES)
+    )
+
+# 批次編碼流程與 groupfinal 共用，只提供 DRai 的模型、ITEMS 與提示
+coder = TranscriptCoder(MODEL_NAME, ITEMS, build_prompt(), build_json_prompt(), ALLOWED_VALUES, label="drai")
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python DRai.py <path_to_csv>")
+        print("Usage: python DRai.py <path_to_csv> [--resume] [--stream]")
         sys.exit(1)
     
     input_csv = sys.argv[1]
     output_csv = "output.csv"
-    if os.path.exists(output_csv):
-        os.remove(output_csv)
+    # --resume：沿用上次中斷時的進度，只補跑尚未完成的批次
+    resume = "--resume" in sys.argv[2:]
+    # --stream：以 chunksize 分段讀取 CSV，邊讀邊送出，記憶體用量不隨檔案大小成長
+    stream = "--stream" in sys.argv[2:]
+    checkpoint = BatchCheckpoint(output_csv, input_csv, resume=resume)
     
-    df = pd.read_csv(input_csv)
+    if stream:
+        reader = pd.read_csv(input_csv, chunksize=CHUNK_SIZE)
+        first_chunk = next(reader)
+        chunks = itertools.chain([first_chunk], reader)
+        total = "?"
+    else:
+        first_chunk = pd.read_csv(input_csv)
+        chunks = [first_chunk]
+        total = len(first_chunk)
     gemini_api_key = os.environ.get("GEMINI_API_KEY")
     if not gemini_api_key:
         raise ValueError("請設定環境變數 GEMINI_API_KEY")
-    client = genai.Client(api_key=gemini_api_key)
+    client = get_genai_client(gemini_api_key)
+    cache = ResponseCache(CACHE_PATH, max_entries=CACHE_MAX_ENTRIES)
+    limiter = TokenBucket(REQUESTS_PER_SECOND)
     
-    dialogue_col = select_dialogue_column(df)
+    dialogue_col = select_dialogue_column(first_chunk)
     print(f"使用欄位作為逐字稿：{dialogue_col}")
     
-    batch_size = 10
-    total = len(df)
-    for start_idx in range(0, total, batch_size):
-        end_idx = min(start_idx + batch_size, total)
-        batch = df.iloc[start_idx:end_idx]
-        dialogues = batch[dialogue_col].tolist()
-        dialogues = [str(d).strip() for d in dialogues]
-        batch_results = process_batch_dialogue(client, dialogues)
+    sizer = AdaptiveBatchSizer(TOKEN_BUDGET, estimate_tokens(build_prompt()), max_rows=MAX_BATCH_ROWS)
+    # 結果依序寫回，已完成的部分一定是開頭連續的一段，從該處開始打包即可
+    batches = iter_chunk_batches(chunks, dialogue_col, sizer, start=checkpoint.rows_done)
+
+    def code_batch(item):
+        _, _, _, dialogues = item
+        if RESPONSE_MODE == "json":
+            return coder.code_batch_json(client, dialogues, cache=cache, limiter=limiter)
+        return code_with_split(
+            lambda part, strict: coder.code_batch(
+                client, part, cache=cache, limiter=limiter, strict=strict),
+            dialogues,
+            sizer,
+        )
+
+    # 多個批次同時送出，結果仍依輸入順序寫回
+    for (start_idx, end_idx, batch, _), batch_results in run_batches(
+        code_batch, batches, max_workers=MAX_WORKERS
+    ):
         batch_df = batch.copy()
         for item in ITEMS:
             batch_df[item] = [res.get(item, "") for res in batch_results]
-        if start_idx == 0:
-            batch_df.to_csv(output_csv, index=False, encoding="utf-8-sig")
-        else:
-            batch_df.to_csv(output_csv, mode='a', index=False, header=False, encoding="utf-8-sig")
+        checkpoint.write_batch(batch_df, start_idx, end_idx)
         print(f"已處理 {end_idx} 筆 / {total}")
-        time.sleep(1)
     
+    checkpoint.finish()
+    cache.close()
+    print("API 呼叫統計：", get_llm_client().metrics.snapshot())
     print("全部處理完成。最終結果已寫入：", output_csv)
 
 if __name__ == "__main__":
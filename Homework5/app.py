@@ -1,17 +1,21 @@
 import os
-import asyncio
+import sys
 import json
-import threading
+import signal
 import pandas as pd
 from dotenv import load_dotenv, find_dotenv
 from flask import Flask, render_template, request
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
 from werkzeug.utils import secure_filename
-from google import genai
 from autogen_agentchat.agents import AssistantAgent
 from autogen_agentchat.teams import RoundRobinGroupChat
 from autogen_agentchat.messages import TextMessage
 from EMOwithSnow import generate_quiz_score_plot  # ✅ 匯入改好的 function
+from config import WORKER_THREADS, WORKER_MAX_PENDING, WORKER_SHUTDOWN_TIMEOUT
+from worker_pool import WorkerPool, QueueFullError
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.llm_client import get_genai_client, get_llm_client
 
 # ✅ 初始化 Flask 與 SocketIO
 app = Flask(__name__)
@@ -19,13 +23,16 @@ app.config['UPLOAD_FOLDER'] = 'uploads'
 socketio = SocketIO(app, async_mode='threading')
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# ✅ 共用的背景工作池：執行緒數與排隊數有上限，多 Agent 分析都在同一個長駐 event loop 上執行
+worker_pool = WorkerPool(max_workers=WORKER_THREADS, max_pending=WORKER_MAX_PENDING)
+
 # ✅ 載入 .env 並初始化 Gemini
 dotenv_path = find_dotenv()
 load_dotenv(dotenv_path)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# ✅ 建立 Gemini 客戶端與模型
-client = genai.Client(api_key=GEMINI_API_KEY)
+# ✅ 建立 Gemini 客戶端與模型（與 mcp.ModelClient 共用同一個連線池）
+client = get_genai_client(GEMINI_API_KEY)
 
 # ✅ 封裝 autogen client
 class GeminiChatCompletionClient:
@@ -41,9 +48,11 @@ class GeminiChatCompletionClient:
             elif isinstance(m, dict) and 'content' in m:
                 parts.append(str(m['content']))
         content = "\n".join(parts)
-        response = client.models.generate_content(
+        response = get_llm_client().call(
+            client.models.generate_content,
             model=self.model,
-            contents=content
+            contents=content,
+            label="autogen"
         )
         return type("Response", (), {
             "text": response.text,
@@ -57,13 +66,23 @@ class GeminiChatCompletionClient:
 model_client = GeminiChatCompletionClient()
 
 # ✅ 多 Agent 分析（保留原來程式碼）
-from multiagent import run_multiagent_analysis
+from multiagent import run_multiagent_analysis, start_stream, end_stream
 
 # ✅ Flask 路由
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# ✅ 每個瀏覽器分頁在連線時以自己的 session id 加入 room，上傳分析的進度只送到該 room
+def valid_room(room):
+    return isinstance(room, str) and 0 < len(room) <= 64 and room.replace('-', '').isalnum()
+
+@socketio.on('join')
+def handle_join(data):
+    room = (data or {}).get('room')
+    if valid_room(room):
+        join_room(room)
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -71,15 +90,22 @@ def upload_file():
     file = request.files['file']
     if file.filename == '':
         return 'No selected file', 400
+    room = request.form.get('room')
+    if not valid_room(room):
+        return 'Missing or invalid room', 400
     if file:
         filename = secure_filename(file.filename)
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(file_path)
-        socketio.emit('update', {'message': '🟢 檔案上傳成功，開始分析中...'})
-        threading.Thread(target=background_task, args=(file_path,)).start()
+        try:
+            worker_pool.submit(background_task, file_path, room)
+        except QueueFullError as e:
+            print(f"⚠️ 拒絕上傳：{e}")
+            return 'Server is busy, please retry later.', 429, {'Retry-After': '30'}
+        socketio.emit('update', {'message': '🟢 檔案上傳成功，開始分析中...'}, to=room)
         return 'File uploaded and processing started.', 200
 
-def background_task(file_path):
+def background_task(file_path, room):
     try:
         df = pd.read_csv(file_path)
 
@@ -90,12 +116,12 @@ def background_task(file_path):
         plot_path = generate_quiz_score_plot(user_id, df)
 
         # ✅ 告訴前端圖片已經完成
-        socketio.emit('plot_generated', {'plot_url': '/' + plot_path})
+        socketio.emit('plot_generated', {'plot_url': '/' + plot_path}, to=room)
 
         # ✅ 再跑多 Agent 分析
-        asyncio.run(run_multiagent_analysis(socketio, user_id, df))
+        worker_pool.run_async(run_multiagent_analysis(socketio, user_id, df, room=room))
     except Exception as e:
-        socketio.emit('update', {'message': f"❌ 分析過程出現錯誤: {str(e)}"})
+        socketio.emit('update', {'message': f"❌ 分析過程出現錯誤: {str(e)}"}, to=room)
 
 # ✅ Gemini 聊天區支援即時回應
 @socketio.on('chat_message')
@@ -103,22 +129,46 @@ def handle_user_chat(data):
     user_message = data.get('message', '').strip()
     if not user_message:
         return
-    
-    socketio.emit('ai_reply', {'message': '💬 Gemini 正在思考中，請稍候...'})
+
+    # 聊天回覆只送回發問的連線（每個連線預設就在以自己 sid 命名的 room 中）
+    room = request.sid
+    socketio.emit('ai_reply', {'message': '💬 Gemini 正在思考中，請稍候...'}, to=room)
 
     def chat_reply():
+        # 以串流方式逐段送出回覆，前端一收到第一段就開始顯示
+        stream_id = None
         try:
-            response = client.models.generate_content(
+            for chunk in get_llm_client().stream(
+                client.models.generate_content_stream,
                 model="gemini-2.5-pro-exp-03-25",
                 contents=f"你是日文教學專家，要用正體中文或英文來回應，以下的對話內容：{user_message}",
-            )
-            
-            reply = response.text.strip()
-            socketio.emit('ai_reply', {'message': reply})
+                label="chat"
+            ):
+                if not chunk.text:
+                    continue
+                if stream_id is None:
+                    stream_id = start_stream(socketio, "🤖 Gemini：", 'chat', room=room)
+                socketio.emit('stream_chunk', {'stream_id': stream_id, 'chunk': chunk.text}, to=room)
         except Exception as e:
-            socketio.emit('ai_reply', {'message': f"⚠️ 發生錯誤：{str(e)}"})
+            socketio.emit('ai_reply', {'message': f"⚠️ 發生錯誤：{str(e)}"}, to=room)
+        finally:
+            if stream_id is not None:
+                end_stream(socketio, stream_id, room=room)
 
-    threading.Thread(target=chat_reply).start()
+    try:
+        worker_pool.submit(chat_reply)
+    except QueueFullError:
+        socketio.emit('ai_reply', {'message': '⚠️ 目前使用人數過多，請稍後再試。'}, to=room)
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
+    # SIGTERM 轉成 SystemExit，讓 Ctrl+C 與 kill 都會走到 finally，
+    # 在 Python 結束流程等待執行緒池之前先關閉工作池（取消排隊中的工作）
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        socketio.run(app, debug=True)
+    finally:
+        if not worker_pool.shutdown(WORKER_SHUTDOWN_TIMEOUT):
+            # 逾時仍有執行中的工作：直譯器結束時會 join 執行緒池，只能直接結束行程
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(1)
@@ -16,4 +16,15 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
 HF_API_KEY = os.getenv('HF_API_KEY', '')
 
 # ✅ 其他可擴充設定
-DEBUG_MODE = os.getenv('DEBUG_MODE', 'false').lower() == 'true'
\ No newline at end of file
+DEBUG_MODE = os.getenv('DEBUG_MODE', 'false').lower() == 'true'
+
+# ✅ 背景工作池設定
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', '4'))              # 同時處理的上傳 / 聊天數
+WORKER_MAX_PENDING = int(os.getenv('WORKER_MAX_PENDING', '16'))     # 執行中 + 排隊中的上限，超過回傳 429
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv('WORKER_SHUTDOWN_TIMEOUT', '30'))
+
+# ✅ Agent 上下文設定
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '4000'))    # 保留原文的最近訊息 token 上限
+CONTEXT_SUMMARY_TOKENS = int(os.getenv('CONTEXT_SUMMARY_TOKENS', '600'))  # 較早訊息摘要的 token 上限
+# 'llm'（由模型把較早的對話濃縮成滾動摘要）/ 'truncate'（不呼叫模型：只保留每則訊息開頭，超過上限丟掉最舊的，並非摘要）
+CONTEXT_SUMMARY_MODE = os.getenv('CONTEXT_SUMMARY_MODE', 'llm')
\ No newline at end of file
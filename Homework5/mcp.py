@@ -1,21 +1,32 @@
 # mcp.py
 import os
+import sys
 import asyncio
-from config import DEFAULT_MODEL, MODEL_PROVIDER, GEMINI_API_KEY, OPENAI_API_KEY, HF_API_KEY
+from collections import deque
+from config import (
+    DEFAULT_MODEL, MODEL_PROVIDER, GEMINI_API_KEY, OPENAI_API_KEY, HF_API_KEY,
+    CONTEXT_TOKEN_BUDGET, CONTEXT_SUMMARY_TOKENS, CONTEXT_SUMMARY_MODE,
+)
 
-# ✅ 載入不同 Provider 的 LLM client
-from google import genai
-import openai
-import requests
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.llm_client import get_genai_client, get_async_http_client, get_async_openai_client, get_llm_client
+from common.batching import estimate_tokens
 
 class ModelClient:
+    """
+    各 Provider 都使用原生 async 呼叫，generate 不會阻塞 event loop：
+    - gemini：google-genai 的 client.aio
+    - openai：AsyncOpenAI
+    - hf：同一個 event loop 共用的 httpx.AsyncClient
+    """
     def __init__(self, model=DEFAULT_MODEL, provider=MODEL_PROVIDER):
         self.model = model
         self.provider = provider
+        self.llm = get_llm_client()
         if provider == 'gemini':
-            self.client = genai.Client(api_key=GEMINI_API_KEY)
+            self.client = get_genai_client(GEMINI_API_KEY)
         elif provider == 'openai':
-            openai.api_key = OPENAI_API_KEY
+            self.client = OPENAI_API_KEY  # AsyncOpenAI 依 event loop 建立，這裡只保存金鑰
         elif provider == 'hf':
             self.client = HF_API_KEY  # just save token
         else:
@@ -24,36 +35,136 @@ class ModelClient:
     async def generate(self, messages: list):
         content = "\n".join(messages)
         if self.provider == 'gemini':
-            response = self.client.models.generate_content(
+            response = await self.llm.acall(
+                self.client.aio.models.generate_content,
                 model=self.model,
-                contents=content
+                contents=content,
+                label="gemini"
             )
             return response.text.strip()
         elif self.provider == 'openai':
-            response = openai.ChatCompletion.create(
+            response = await self.llm.acall(
+                get_async_openai_client(self.client).chat.completions.create,
                 model=self.model,
-                messages=[{"role": "user", "content": content}]
+                messages=[{"role": "user", "content": content}],
+                label="openai"
             )
             return response.choices[0].message.content.strip()
         elif self.provider == 'hf':
             url = f"https://api-inference.huggingface.co/models/{self.model}"
             headers = {"Authorization": f"Bearer {self.client}"}
             payload = {"inputs": content}
-            r = requests.post(url, headers=headers, json=payload)
-            r.raise_for_status()
+
+            async def post():
+                r = await get_async_http_client().post(url, headers=headers, json=payload)
+                r.raise_for_status()  # 讓 429 / 5xx 以 HTTPStatusError 丟出，交給共用層重試
+                return r
+
+            r = await self.llm.acall(post, label="hf")
             return r.json()[0]['generated_text'].strip()
         else:
             raise ValueError("Invalid model provider")
 
+    async def generate_stream(self, messages: list):
+        """逐塊 yield 模型輸出的文字；hf 的 Inference API 不支援串流，整段結果作為單一一塊"""
+        content = "\n".join(messages)
+        if self.provider == 'gemini':
+            async for chunk in self.llm.astream(
+                self.client.aio.models.generate_content_stream,
+                model=self.model,
+                contents=content,
+                label="gemini"
+            ):
+                if chunk.text:
+                    yield chunk.text
+        elif self.provider == 'openai':
+            async for chunk in self.llm.astream(
+                get_async_openai_client(self.client).chat.completions.create,
+                model=self.model,
+                messages=[{"role": "user", "content": content}],
+                stream=True,
+                label="openai"
+            ):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        else:
+            yield await self.generate(messages)
+
+SUMMARY_LINE_CHARS = 120
+SUMMARY_PROMPT = "請將以下較早的對話內容濃縮成一段重點摘要，保留結論、數據與尚未解決的問題，不要加入新內容："
+
 class ContextManager:
-    def __init__(self):
-        self.history = []
+    """
+    有 token 上限的上下文：
+    - 最近的訊息保留原文（滑動視窗），總量超過 token_budget 時最舊的訊息移出視窗
+    - summary_mode='llm'（預設）：移出的訊息整則併入滾動摘要，超過 summary_tokens 時由 compact()
+      請模型把摘要與新移出的訊息濃縮成一段，較早的對話以摘要形式保留
+    - summary_mode='truncate'：不呼叫模型，只保留移出訊息的開頭一段，超過 summary_tokens 時丟掉最舊的，
+      等於第二層較短的滑動視窗，更早的對話會遺失
+    - 每次新增訊息只做常數次的 deque 操作，get_context 的長度有上限，每輪成本不隨對話輪數增加
+    """
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, summary_tokens=CONTEXT_SUMMARY_TOKENS,
+                 summary_mode=CONTEXT_SUMMARY_MODE, min_recent=2):
+        self.token_budget = token_budget
+        self.summary_budget = summary_tokens
+        self.summary_mode = summary_mode
+        self.min_recent = min_recent
+        self.history = deque()  # (訊息, token 數)
+        self.history_tokens = 0
+        self.summary = deque()  # (摘要行, token 數)
+        self.summary_tokens = 0
+        self.uncompacted = 0  # 上次濃縮後新併入的訊息數
 
     def add_message(self, role, content):
-        self.history.append(f"[{role}] {content}")
+        message = f"[{role}] {content}"
+        tokens = estimate_tokens(message)
+        self.history.append((message, tokens))
+        self.history_tokens += tokens
+        while self.history_tokens > self.token_budget and len(self.history) > self.min_recent:
+            old, old_tokens = self.history.popleft()
+            self.history_tokens -= old_tokens
+            if self.summary_mode == "llm":
+                self._add_summary_line(old, old_tokens)
+            else:
+                line = old if len(old) <= SUMMARY_LINE_CHARS else old[:SUMMARY_LINE_CHARS] + "…"
+                self._add_summary_line(line, estimate_tokens(line))
+                self._trim_summary()
+
+    def _add_summary_line(self, line, tokens):
+        self.summary.append((line, tokens))
+        self.summary_tokens += tokens
+        self.uncompacted += 1
+
+    def _trim_summary(self):
+        while self.summary_tokens > self.summary_budget and len(self.summary) > 1:
+            _, tokens = self.summary.popleft()
+            self.summary_tokens -= tokens
+
+    async def compact(self, summarize):
+        """
+        summary_mode='llm' 時，摘要超過上限就以 summarize(text) 把既有摘要與新移出的訊息濃縮成一段；
+        失敗時改為丟掉最舊的摘要行
+        """
+        if self.summary_tokens <= self.summary_budget or self.uncompacted == 0:
+            return
+        try:
+            condensed = await summarize("\n".join(line for line, _ in self.summary))
+        except Exception as e:
+            print(f"⚠️ 上下文摘要失敗，改為截斷：{e}")
+            self._trim_summary()
+            return
+        tokens = estimate_tokens(condensed)
+        self.summary.clear()
+        self.summary.append((condensed, tokens))
+        self.summary_tokens = tokens
+        self.uncompacted = 0
 
     def get_context(self):
-        return [msg for msg in self.history]
+        context = []
+        if self.summary:
+            context.append("[先前對話摘要]\n" + "\n".join(line for line, _ in self.summary))
+        context.extend(message for message, _ in self.history)
+        return context
 
 class ProtocolAgent:
     def __init__(self, name, role, model_client: ModelClient):
@@ -62,10 +173,23 @@ class ProtocolAgent:
         self.model_client = model_client
         self.context_manager = ContextManager()  # ✅ 每個 Agent 自己有上下文
 
-    async def act(self, input_text):
+    async def summarize(self, text):
+        return await self.model_client.generate([SUMMARY_PROMPT, text])
+
+    async def act(self, input_text, on_chunk=None):
+        """on_chunk(text)：有指定時改用串流，每收到一段文字就呼叫一次；回傳值仍為完整回覆"""
         self.context_manager.add_message(self.role, input_text)
+        if self.context_manager.summary_mode == "llm":
+            await self.context_manager.compact(self.summarize)
         context = self.context_manager.get_context()
-        response = await self.model_client.generate(context)
+        if on_chunk is None:
+            response = await self.model_client.generate(context)
+        else:
+            parts = []
+            async for chunk in self.model_client.generate_stream(context):
+                parts.append(chunk)
+                on_chunk(chunk)
+            response = "".join(parts).strip()
         self.context_manager.add_message(self.name, response)
         return response
 
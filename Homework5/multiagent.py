@@ -1,13 +1,42 @@
 # multiagent.py (新版，MCP 架構)
 import asyncio
 import json
+import uuid
 from flask_socketio import SocketIO
 import pandas as pd
 
 from mcp import ModelClient, ProtocolAgent
 
+MAX_DISPLAY_CHARS = 1500
+
+# ✅ 串流輸出：stream_start 建立一則訊息，stream_chunk 逐段附加文字，stream_end 結束
+# room：只送給該 Socket.IO room（上傳者的 session 或聊天的連線），None 時廣播給所有人
+def start_stream(socketio: SocketIO, prefix, tag, source=None, room=None):
+    stream_id = uuid.uuid4().hex
+    socketio.emit('stream_start', {'stream_id': stream_id, 'prefix': prefix, 'tag': tag, 'source': source}, to=room)
+    return stream_id
+
+def stream_emitter(socketio: SocketIO, stream_id, room=None, limit=MAX_DISPLAY_CHARS):
+    """回傳 on_chunk：把收到的文字逐段送到前端，累計超過 limit 字後不再送出"""
+    sent = 0
+
+    def on_chunk(chunk):
+        nonlocal sent
+        if sent >= limit:
+            return
+        piece = chunk[:limit - sent]
+        sent += len(piece)
+        socketio.emit('stream_chunk', {'stream_id': stream_id, 'chunk': piece}, to=room)
+
+    return on_chunk
+
+def end_stream(socketio: SocketIO, stream_id, truncated=False, room=None):
+    if truncated:
+        socketio.emit('stream_chunk', {'stream_id': stream_id, 'chunk': "... (內容過長)"}, to=room)
+    socketio.emit('stream_end', {'stream_id': stream_id}, to=room)
+
 # ✅ 多 Agent 分析流程（新版 MCP）
-async def process_user_diary(socketio: SocketIO, user_id, user_entries: pd.DataFrame):
+async def process_user_diary(socketio: SocketIO, user_id, user_entries: pd.DataFrame, room=None):
     model_client = ModelClient()
 
     analysis_agent = ProtocolAgent(
@@ -48,30 +77,24 @@ async def process_user_diary(socketio: SocketIO, user_id, user_entries: pd.DataF
     try:
         for _ in range(6):  # 最多 6 輪互動
             for agent in agents:
-                response = await agent.act(prompt)
                 display_name = display_names.get(agent.name, agent.name)
-
-                if len(response) > 1500:
-                    formatted_text = response[:1500] + "... (內容過長)"
-                else:
-                    formatted_text = response
-
-                socketio.emit('update', {
-                    'message': f"🤖 [{display_name}]：{formatted_text}",
-                    'source': agent.name,
-                    'tag': 'analysis'
-                })
+                stream_id = start_stream(socketio, f"🤖 [{display_name}]：", 'analysis', agent.name, room=room)
+                response = ""
+                try:
+                    response = await agent.act(prompt, on_chunk=stream_emitter(socketio, stream_id, room=room))
+                finally:
+                    end_stream(socketio, stream_id, truncated=len(response) > MAX_DISPLAY_CHARS, room=room)
 
                 if "最終建議：" in response:
                     final_recommendation = response.split("我的建議是：")[-1].strip()
-                    socketio.emit('suggestions', {'suggestions': final_recommendation})
+                    socketio.emit('suggestions', {'suggestions': final_recommendation}, to=room)
                     return  # 提前結束
     except asyncio.CancelledError:
         pass
 
-async def run_multiagent_analysis(socketio: SocketIO, user_id, user_entries: pd.DataFrame):
+async def run_multiagent_analysis(socketio: SocketIO, user_id, user_entries: pd.DataFrame, room=None):
     socketio.emit('update', {
         'message': '🤖 系統：正在啟動分析專家與 AI 助理的協作...',
         'tag': 'analysis'
-    })
-    await process_user_diary(socketio, user_id, user_entries)
+    }, to=room)
+    await process_user_diary(socketio, user_id, user_entries, room=room)
@@ -0,0 +1,94 @@
+# worker_pool.py
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class QueueFullError(Exception):
+    """排隊中的工作已達上限（或伺服器正在關閉），呼叫端應回傳 429"""
+
+class WorkerPool:
+    """
+    整個服務共用的背景工作池：
+    - 有上限的執行緒池處理同步工作（讀檔、繪圖、聊天串流）
+    - 一個長駐的 asyncio event loop（獨立執行緒）執行 async 工作，不再每次上傳都 asyncio.run 開新 loop
+    - 執行中 + 排隊中的工作超過 max_pending 時直接丟出 QueueFullError
+    - shutdown() 停止接收新工作、取消尚未開始的工作，等待執行中的工作（有逾時）後關閉 loop，
+      回傳是否所有工作都已結束
+      需在伺服器結束流程中呼叫（例如 socketio.run 之後的 finally），不能用 atexit：
+      concurrent.futures 自己的結束 hook 會先於 atexit 執行，等所有排隊工作跑完才輪到 atexit
+      執行緒池的執行緒不是 daemon，直譯器結束時仍會等它們跑完；
+      shutdown() 回傳 False 時呼叫端需以 os._exit 結束行程，逾時才真正生效
+    """
+    def __init__(self, max_workers=4, max_pending=16):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="worker")
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self._run_loop, name="worker-loop", daemon=True)
+        self.loop_thread.start()
+        self.idle = threading.Condition()
+        self.active = 0
+        self.closed = False
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _acquire(self):
+        with self.idle:
+            if self.closed:
+                raise QueueFullError("伺服器正在關閉")
+            if self.active >= self.max_pending:
+                raise QueueFullError(f"排隊中的工作已達上限（{self.max_pending}）")
+            self.active += 1
+
+    def _release(self, _future=None):
+        with self.idle:
+            self.active -= 1
+            self.idle.notify_all()
+
+    def submit(self, fn, *args, **kwargs):
+        """送出同步工作；佇列已滿時丟出 QueueFullError"""
+        self._acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except RuntimeError:
+            self._release()
+            raise QueueFullError("伺服器正在關閉")
+        future.add_done_callback(self._release)
+        return future
+
+    def run_async(self, coro):
+        """在背景工作中同步等待 coroutine 於共用 event loop 執行完畢（不另外佔用佇列名額）"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def shutdown(self, timeout=30):
+        with self.idle:
+            if self.closed:
+                return self.active == 0
+            self.closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        deadline = time.monotonic() + timeout
+        with self.idle:
+            while self.active > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"⚠️ 仍有 {self.active} 個工作未完成，強制關閉")
+                    break
+                self.idle.wait(remaining)
+            finished = self.active == 0
+
+        async def cancel_and_stop():
+            # 取消剩下的 async 工作並等它們結束，等待 run_async 的執行緒才會收到 CancelledError 而返回
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.loop.stop()
+
+        asyncio.run_coroutine_threadsafe(cancel_and_stop(), self.loop)
+        self.loop_thread.join(timeout=5)
+        if not self.loop.is_running():
+            self.loop.close()
+        return finished
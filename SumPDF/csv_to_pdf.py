@@ -4,9 +4,13 @@ from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
 import os
+import sys
 from dotenv import load_dotenv
 from google import genai
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.pdf_tables import build_table_chunks
+
 # 載入環境變數並設定 API 金鑰
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -23,18 +27,9 @@ doc = SimpleDocTemplate(pdf_file, pagesize=A4)
 styles = getSampleStyleSheet()
 elements = []
 
-# 將資料轉為表格格式
-data = [df.columns.tolist()] + df.values.tolist()
-
-# 處理表格內容格式（轉為 Paragraph，以避免文字太長）
-formatted_data = []
-for row in data:
-    formatted_row = [Paragraph(str(cell), styles["Normal"]) for cell in row]
-    formatted_data.append(formatted_row)
-
-# 建立 Table 元件
-table = Table(formatted_data, repeatRows=1)
-table.setStyle(TableStyle([
+# 分段建立表格：每段固定列數並重複表頭
+# 數字與短文字直接用字串，較長的文字才轉為 Paragraph（避免文字太長）
+elements.extend(build_table_chunks(df, [
     ("BACKGROUND", (0, 0), (-1, 0), colors.lightblue),
     ("TEXTCOLOR", (0, 0), (-1, 0), colors.whitesmoke),
     ("ALIGN", (0, 0), (-1, -1), "LEFT"),
@@ -42,9 +37,7 @@ table.setStyle(TableStyle([
     ("FONTSIZE", (0, 0), (-1, -1), 9),
     ("BOTTOMPADDING", (0, 0), (-1, 0), 8),
     ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-]))
-
-elements.append(table)
+], styles["Normal"], available_width=doc.width))
 
 # 產出 PDF
 doc.build(elements)
@@ -0,0 +1 @@
+# 各專案（DRai、groupfinal、Homework5 ...）共用的工具模組
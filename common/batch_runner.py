@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    """
+    令牌桶限流器：每秒補充 rate 個令牌，最多累積 capacity 個。
+    每次 API 呼叫前先 acquire() 取得一個令牌，取代固定的 time.sleep(1)。
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError("rate 必須大於 0")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens: float = 1.0):
+        """取得令牌，不足時阻塞等待到補滿為止"""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def run_batches(process_fn, batches, max_workers: int = 4, rate: float = None, bucket: TokenBucket = None):
+    """
+    以執行緒池同時處理多個批次，並依「輸入順序」逐一回傳 (batch, result)。
+    - process_fn：處理單一批次的函式（例如呼叫 TranscriptCoder.code_batch）
+    - batches：批次的 iterable，可為 generator，會邊讀邊送出
+    - max_workers：同時進行中的請求數
+    - rate / bucket：每秒最多處理的批次數（令牌桶）；皆為 None 時不限速，
+      由 process_fn 自行在真正呼叫 API 前 acquire（例如快取命中時不必等待）
+    同時排隊的批次最多 max_workers * 2 個，避免一次把整個檔案載入記憶體。
+    """
+    if bucket is None and rate is not None:
+        bucket = TokenBucket(rate)
+
+    def _task(batch):
+        if bucket is not None:
+            bucket.acquire()
+        return process_fn(batch)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, executor.submit(_task, batch)))
+            if len(pending) >= max_workers * 2:
+                done_batch, future = pending.popleft()
+                yield done_batch, future.result()
+        while pending:
+            done_batch, future = pending.popleft()
+            yield done_batch, future.result()
@@ -0,0 +1,112 @@
+import threading
+
+
+class BatchMismatchError(Exception):
+    """批次回傳的結果筆數與送出的逐字稿筆數不一致（分隔線錯位或輸出被截斷）"""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗估文字的 token 數：
+    - 中日韓等非 ASCII 字元大約 1 字 1 token
+    - 英數字元大約 4 字 1 token
+    """
+    text = str(text)
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    ascii_chars = len(text) - non_ascii
+    return non_ascii + ascii_chars // 4 + 1
+
+
+class AdaptiveBatchSizer:
+    """
+    依 token 預算決定每批要放幾筆逐字稿。
+    - token_budget：單次請求（提示 + 逐字稿）可用的輸入 token 上限
+    - prompt_tokens：提示模板本身佔用的 token
+    - max_rows：每批最多筆數；偵測到分隔線錯位時自動減半，
+      連續成功 grow_after 批後再慢慢加回，但不超過初始上限
+    """
+
+    def __init__(self, token_budget: int, prompt_tokens: int, max_rows: int = 50,
+                 min_rows: int = 1, grow_after: int = 20):
+        self.token_budget = token_budget
+        self.prompt_tokens = prompt_tokens
+        self.max_rows_limit = max_rows
+        self.max_rows = max_rows
+        self.min_rows = min_rows
+        self.grow_after = grow_after
+        self.successes = 0
+        self.lock = threading.Lock()
+
+    def shrink(self, failed_rows: int = None):
+        """把每批上限降為失敗批次筆數的一半；多個同時失敗的批次不會重複減半"""
+        with self.lock:
+            failed_rows = failed_rows or self.max_rows
+            new_size = max(self.min_rows, min(self.max_rows, failed_rows // 2))
+            if new_size < self.max_rows:
+                print(f"⚠️ 偵測到批次結果錯位，每批筆數由 {self.max_rows} 降為 {new_size}")
+            self.max_rows = new_size
+            self.successes = 0
+
+    def record_success(self):
+        with self.lock:
+            self.successes += 1
+            if self.successes >= self.grow_after and self.max_rows < self.max_rows_limit:
+                self.max_rows += 1
+                self.successes = 0
+
+    def pack(self, token_counts, start: int = 0):
+        """
+        依序把各列打包成批次，回傳 (start, end) 範圍的 generator。
+        token_counts[i] 為第 i 列逐字稿的估計 token 數；單列超過預算時自成一批。
+        """
+        total = len(token_counts)
+        batch_start = start
+        while batch_start < total:
+            used = self.prompt_tokens
+            end = batch_start
+            while end < total and end - batch_start < self.max_rows:
+                if end > batch_start and used + token_counts[end] > self.token_budget:
+                    break
+                used += token_counts[end]
+                end += 1
+            yield batch_start, end
+            batch_start = end
+
+
+def iter_chunk_batches(chunks, dialogue_col: str, sizer: AdaptiveBatchSizer, start: int = 0):
+    """
+    逐一讀取 DataFrame 區塊（例如 pd.read_csv(..., chunksize=...) 的結果），
+    在每個區塊內依 token 預算打包，回傳 (start_idx, end_idx, batch_df, dialogues)。
+    start_idx / end_idx 為整個檔案中的列號；start 之前的列（已完成的部分）直接略過。
+    一次只保留目前的區塊在記憶體中，檔案再大也不會整個載入。
+    """
+    offset = 0
+    for chunk in chunks:
+        chunk_len = len(chunk)
+        if offset + chunk_len <= start:
+            offset += chunk_len
+            continue
+        dialogues = [str(d).strip() for d in chunk[dialogue_col]]
+        token_counts = [estimate_tokens(d) for d in dialogues]
+        for s, e in sizer.pack(token_counts, start=max(0, start - offset)):
+            yield offset + s, offset + e, chunk.iloc[s:e], dialogues[s:e]
+        offset += chunk_len
+
+
+def code_with_split(process_fn, dialogues: list, sizer: AdaptiveBatchSizer = None):
+    """
+    呼叫 process_fn(dialogues, strict) 編碼一批逐字稿。
+    strict=True 時 process_fn 應在筆數不符時丟出 BatchMismatchError；
+    此時縮小批次大小，並把這批拆成兩半重送，避免整批結果被補成空白。
+    """
+    try:
+        results = process_fn(dialogues, len(dialogues) > 1)
+    except BatchMismatchError:
+        if sizer is not None:
+            sizer.shrink(len(dialogues))
+        mid = len(dialogues) // 2
+        return (code_with_split(process_fn, dialogues[:mid], sizer)
+                + code_with_split(process_fn, dialogues[mid:], sizer))
+    if sizer is not None:
+        sizer.record_success()
+    return results
@@ -0,0 +1,102 @@
+import json
+import os
+
+
+class BatchCheckpoint:
+    """
+    批次 CSV 編碼的續跑紀錄。
+    - 執行中的結果先寫到 output_csv + ".partial"，全部完成後以 os.replace 原子性改名
+    - 側檔 output_csv + ".progress.json" 記錄已完成的批次範圍 [start, end) 與 partial 檔大小
+    重新啟動並指定 resume=True 時，跳過已完成的批次，只補上缺少的部分。
+    """
+
+    def __init__(self, output_csv: str, input_csv: str = None, resume: bool = False, input_id: str = None):
+        """
+        以 input_csv 的路徑與大小辨識輸入；輸入只存在記憶體中時，改傳 input_id（例如內容雜湊）。
+        """
+        self.output_csv = output_csv
+        self.partial_path = output_csv + ".partial"
+        self.manifest_path = output_csv + ".progress.json"
+        if input_id is not None:
+            self.input_id = {"id": input_id}
+        else:
+            self.input_id = {"path": os.path.abspath(input_csv), "size": os.path.getsize(input_csv)}
+        self.completed = []
+        self.partial_size = 0
+
+        manifest = self._load_manifest() if resume else None
+        if manifest and manifest.get("input") == self.input_id and os.path.exists(self.partial_path):
+            self.completed = [list(r) for r in manifest.get("completed", [])]
+            self.partial_size = manifest.get("partial_size", 0)
+            # 當機可能發生在寫入 CSV 之後、更新紀錄之前，先截掉未記錄的尾端資料
+            with open(self.partial_path, "r+b") as f:
+                f.truncate(self.partial_size)
+            print(f"♻️ 續跑模式：已完成 {self.rows_done} 筆，從中斷處繼續")
+        else:
+            if resume:
+                print("⚠️ 找不到可續跑的紀錄（或輸入檔已變更），將從頭開始")
+            for path in (self.partial_path, self.manifest_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 續跑紀錄讀取失敗：{e}")
+            return None
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "input": self.input_id,
+                "completed": self.completed,
+                "partial_size": self.partial_size,
+            }, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    @property
+    def rows_done(self) -> int:
+        """從第 0 筆開始連續完成的筆數"""
+        done = 0
+        for start, end in self.completed:
+            if start > done:
+                break
+            done = max(done, end)
+        return done
+
+    def is_done(self, start: int, end: int) -> bool:
+        return any(s <= start and end <= e for s, e in self.completed)
+
+    def write_batch(self, batch_df, start: int, end: int):
+        """把一個批次的結果附加到 partial 檔，並記錄為已完成"""
+        header = self.partial_size == 0
+        encoding = "utf-8-sig" if header else "utf-8"
+        with open(self.partial_path, "a", encoding=encoding, newline="") as f:
+            batch_df.to_csv(f, index=False, header=header)
+            f.flush()
+            os.fsync(f.fileno())
+        self.partial_size = os.path.getsize(self.partial_path)
+
+        self.completed.append([start, end])
+        self.completed.sort()
+        merged = []
+        for s, e in self.completed:
+            if merged and s <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], e)
+            else:
+                merged.append([s, e])
+        self.completed = merged
+        self._save_manifest()
+
+    def finish(self):
+        """全部完成後原子性地改名成正式輸出檔，並移除續跑紀錄"""
+        if not os.path.exists(self.partial_path):
+            open(self.partial_path, "w").close()
+        os.replace(self.partial_path, self.output_csv)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+
+# 斷路器：連續遇到額度錯誤（429）後直接拒絕呼叫一段冷卻時間，讓呼叫端立刻走備用方案
+# 狀態：closed（正常）→ open（冷卻中，全部拒絕）→ half_open（放行一個試探請求）
+#       試探成功回到 closed，失敗重新進入 open
+
+BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "3"))
+BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "60"))
+
+
+class CircuitOpenError(Exception):
+    """斷路器開啟中，呼叫未送出"""
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def before_call(self) -> bool:
+        """
+        呼叫前檢查；開啟中（或已有試探請求進行中）時丟出 CircuitOpenError。
+        回傳 True 表示這次呼叫是試探請求，呼叫結束後（包含被取消）必須呼叫 release_probe()
+        """
+        with self.lock:
+            if self.state == "closed":
+                return False
+            if self.state == "open":
+                remaining = self.opened_at + self.cooldown - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpenError(f"{self.name} 斷路器開啟中，{remaining:.0f} 秒後再試")
+                self.state = "half_open"
+            if self.probing:
+                raise CircuitOpenError(f"{self.name} 斷路器試探中")
+            self.probing = True
+            return True
+
+    def release_probe(self):
+        """試探請求結束；沒有 record() 就結束（被取消、串流提早關閉）時維持 half_open，讓下一個呼叫再試探"""
+        with self.lock:
+            self.probing = False
+
+    def record(self, quota_error: bool):
+        """回報呼叫結果；只有額度錯誤會累計，其他結果都視為服務恢復"""
+        with self.lock:
+            self.probing = False
+            if not quota_error:
+                self.state = "closed"
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    print(f"⚠️ [{self.name}] 連續 {self.failures} 次額度錯誤，{self.cooldown:.0f} 秒內直接改用備用方案")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.state == "open"
+
+
+_lock = threading.Lock()
+_breakers = {}
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """同名的斷路器在整個行程共用（例如同一組 API 金鑰共用 "gemini"）"""
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
@@ -0,0 +1,93 @@
+import json
+
+
+def strip_code_fence(text: str) -> str:
+    """移除模型回覆外層的 ```json ... ``` 標記"""
+    cleaned = text.strip()
+    if cleaned.startswith("```"):
+        lines = cleaned.splitlines()
+        if lines[0].startswith("```"):
+            lines = lines[1:]
+        if lines and lines[-1].strip() == "```":
+            lines = lines[:-1]
+        cleaned = "\n".join(lines).strip()
+    return cleaned
+
+
+def json_array_instructions(items: list, allowed_values: tuple) -> str:
+    """要求模型以單一 JSON 陣列回覆、每個元素帶 index 的提示段落"""
+    allowed = " 或 ".join(f'"{v}"' for v in allowed_values)
+    example = ", ".join(f'"{item}": "{allowed_values[0]}"' for item in items[:2])
+    return (
+        "\n\n請只回傳一個 JSON 陣列，不要加入其他說明文字。"
+        "陣列中每個元素對應一筆逐字稿，必須包含該筆的 \"index\"（整數，與逐字稿前的 [編號] 相同）"
+        f"以及上列每一個項目，各項目的值只能是 {allowed}。\n"
+        "例如：\n"
+        f"[{{\"index\": 0, {example}, ...}}, {{\"index\": 1, ...}}]"
+    )
+
+
+def format_indexed(indexed_dialogues: list) -> str:
+    """把 [(index, 逐字稿), ...] 排成帶編號的文字區塊"""
+    return "\n\n".join(f"[{i}]\n{text}" for i, text in indexed_dialogues)
+
+
+def _normalize_value(value):
+    if value is None:
+        return ""
+    return str(value).strip()
+
+
+def parse_json_array(text: str, items: list, expected: set, allowed_values: tuple = None) -> dict:
+    """
+    解析 JSON 陣列回覆，只保留 index 在 expected 之中、且每個項目都合法的元素。
+    回傳 {index: {item: value}}；格式錯誤的元素直接略過，由呼叫端重新請求。
+    """
+    try:
+        data = json.loads(strip_code_fence(text))
+    except ValueError as e:
+        print(f"⚠️ 解析 JSON 陣列失敗：{e}")
+        return {}
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        return {}
+
+    valid = {}
+    for element in data:
+        if not isinstance(element, dict):
+            continue
+        try:
+            index = int(element.get("index"))
+        except (TypeError, ValueError):
+            continue
+        if index not in expected or index in valid:
+            continue
+        if any(item not in element for item in items):
+            continue
+        row = {item: _normalize_value(element[item]) for item in items}
+        if allowed_values is not None and any(v not in allowed_values for v in row.values()):
+            continue
+        valid[index] = row
+    return valid
+
+
+def request_json_rows(send_fn, dialogues: list, items: list, allowed_values: tuple = None, max_rounds: int = 3):
+    """
+    以 JSON 陣列模式編碼多筆逐字稿。
+    send_fn(indexed_text) 送出帶編號的逐字稿區塊並回傳模型文字（失敗時回傳 None）。
+    每一輪只重送缺漏或驗證失敗的筆數，最多 max_rounds 輪；
+    回傳與 dialogues 等長的 list，仍失敗的位置為 None。
+    """
+    results = {}
+    missing = list(range(len(dialogues)))
+    for _ in range(max_rounds):
+        if not missing:
+            break
+        text = send_fn(format_indexed([(i, dialogues[i]) for i in missing]))
+        if text is not None:
+            results.update(parse_json_array(text, items, set(missing), allowed_values))
+        missing = [i for i in missing if i not in results]
+        if missing:
+            print(f"⚠️ 有 {len(missing)} 筆缺漏或格式不符，僅重新請求這些筆數")
+    return [results.get(i) for i in range(len(dialogues))]
@@ -0,0 +1,324 @@
+import asyncio
+import inspect
+import os
+import random
+import threading
+import time
+import weakref
+
+from common.circuit_breaker import get_circuit_breaker
+
+# 所有專案共用的 LLM 呼叫層：
+# - 整個行程共用同一個 Gemini client / requests.Session，重複使用 keep-alive 連線
+# - 以 semaphore 限制同時進行中的請求數
+# - 遇到 429 / 5xx 時以 jitter 指數退避重試
+# - 可指定斷路器（circuit），額度用盡時不再重試、直接讓呼叫端走備用方案
+# - 記錄每次呼叫的延遲與 token 用量
+# - acall 為 async 版本；async 的 semaphore 與 HTTP client 依 event loop 各自建立
+# - stream / astream 逐塊回傳串流結果，只在收到第一塊之前重試
+
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30.0"))
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+QUOTA_STATUS = {429}
+
+
+def status_code_of(exc: Exception):
+    """從各家 SDK 的例外中取出 HTTP 狀態碼（google-genai、google.api_core、openai、requests）"""
+    for attr in ("status_code", "code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def token_usage_of(response):
+    """回傳 (prompt_tokens, completion_tokens)，取不到時為 (0, 0)"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        return (getattr(usage, "prompt_token_count", 0) or 0,
+                getattr(usage, "candidates_token_count", 0) or 0)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        return (getattr(usage, "prompt_tokens", 0) or 0,
+                getattr(usage, "completion_tokens", 0) or 0)
+    return 0, 0
+
+
+class LLMMetrics:
+    """依 label 統計呼叫次數、錯誤、重試、總延遲與 token 用量"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _entry(self, label):
+        return self.stats.setdefault(label, {
+            "calls": 0, "errors": 0, "retries": 0, "latency": 0.0,
+            "prompt_tokens": 0, "completion_tokens": 0,
+        })
+
+    def record(self, label, latency, prompt_tokens=0, completion_tokens=0, error=False, retry=False):
+        with self.lock:
+            entry = self._entry(label)
+            entry["calls"] += 1
+            entry["latency"] += latency
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            if error:
+                entry["errors"] += 1
+            if retry:
+                entry["retries"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            result = {}
+            for label, entry in self.stats.items():
+                result[label] = dict(entry)
+                result[label]["avg_latency"] = entry["latency"] / entry["calls"] if entry["calls"] else 0.0
+            return result
+
+
+class LLMClient:
+    """
+    包裝任意 SDK 的同步呼叫：
+        llm.call(client.models.generate_content, model=..., contents=..., label="drai")
+    超過重試次數或非可重試的錯誤會原樣丟出，呼叫端原本的 except 仍然有效。
+    指定 circuit 名稱時，斷路器開啟期間直接丟出 CircuitOpenError，不送出請求。
+    """
+
+    def __init__(self, max_concurrency: int = MAX_CONCURRENCY, max_retries: int = MAX_RETRIES,
+                 base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY):
+        self.max_concurrency = max_concurrency
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = LLMMetrics()
+
+    def backoff_delay(self, attempt: int) -> float:
+        # full jitter：0 ~ base * 2^attempt 之間隨機，避免多個執行緒同時重試
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _retry_delay(self, exc, label, attempt, breaker, started):
+        """記錄失敗並決定是否重試；回傳等待秒數，不重試時回傳 None"""
+        status = status_code_of(exc)
+        retry = status in RETRYABLE_STATUS and attempt < self.max_retries
+        if breaker is not None:
+            breaker.record(quota_error=status in QUOTA_STATUS)
+            retry = retry and not breaker.is_open()
+        self.metrics.record(label, time.perf_counter() - started, error=True, retry=retry)
+        if not retry:
+            return None
+        delay = self.backoff_delay(attempt)
+        print(f"⚠️ [{label}] API 回傳 {status}，{delay:.1f} 秒後重試（第 {attempt + 1} 次）")
+        return delay
+
+    def _record_success(self, response, label, breaker, started):
+        if breaker is not None:
+            breaker.record(quota_error=False)
+        prompt_tokens, completion_tokens = token_usage_of(response)
+        self.metrics.record(label, time.perf_counter() - started, prompt_tokens, completion_tokens)
+
+    def call(self, fn, *args, label: str = "llm", circuit: str = None, **kwargs):
+        breaker = get_circuit_breaker(circuit) if circuit else None
+        attempt = 0
+        while True:
+            probe = breaker.before_call() if breaker is not None else False
+            try:
+                with self.semaphore:
+                    started = time.perf_counter()
+                    try:
+                        response = fn(*args, **kwargs)
+                    except Exception as e:
+                        delay = self._retry_delay(e, label, attempt, breaker, started)
+                        if delay is None:
+                            raise
+                    else:
+                        self._record_success(response, label, breaker, started)
+                        return response
+            finally:
+                if probe:
+                    breaker.release_probe()
+            # 退避等待時不佔用 semaphore，讓其他請求可以進行
+            time.sleep(delay)
+            attempt += 1
+
+    def _async_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            if loop not in self._async_semaphores:
+                self._async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+            return self._async_semaphores[loop]
+
+    async def acall(self, fn, *args, label: str = "llm", circuit: str = None, **kwargs):
+        """
+        call 的 async 版本：fn(*args, **kwargs) 需回傳 awaitable（例如 client.aio.models.generate_content）。
+        等待、重試退避都不會阻塞 event loop；重試與斷路器規則與 call 相同。
+        """
+        breaker = get_circuit_breaker(circuit) if circuit else None
+        semaphore = self._async_semaphore()
+        attempt = 0
+        while True:
+            probe = breaker.before_call() if breaker is not None else False
+            try:
+                async with semaphore:
+                    started = time.perf_counter()
+                    try:
+                        response = await fn(*args, **kwargs)
+                    except Exception as e:
+                        delay = self._retry_delay(e, label, attempt, breaker, started)
+                        if delay is None:
+                            raise
+                    else:
+                        self._record_success(response, label, breaker, started)
+                        return response
+            finally:
+                if probe:
+                    breaker.release_probe()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stream(self, fn, *args, label: str = "llm", circuit: str = None, **kwargs):
+        """
+        串流版本（同步）：fn(*args, **kwargs) 回傳可迭代的串流（例如 client.models.generate_content_stream），逐塊 yield。
+        還沒收到任何內容前的錯誤照一般規則重試；已送出部分內容後發生錯誤則直接丟出，避免重複輸出。
+        """
+        breaker = get_circuit_breaker(circuit) if circuit else None
+        attempt = 0
+        while True:
+            probe = breaker.before_call() if breaker is not None else False
+            try:
+                with self.semaphore:
+                    started = time.perf_counter()
+                    received = False
+                    last = None
+                    try:
+                        for chunk in fn(*args, **kwargs):
+                            received = True
+                            last = chunk
+                            yield chunk
+                    except Exception as e:
+                        delay = self._retry_delay(e, label, self.max_retries if received else attempt, breaker, started)
+                        if delay is None:
+                            raise
+                    else:
+                        self._record_success(last, label, breaker, started)
+                        return
+            finally:
+                # 呼叫端提早關閉串流（GeneratorExit）時也要釋放試探名額
+                if probe:
+                    breaker.release_probe()
+            time.sleep(delay)
+            attempt += 1
+
+    async def astream(self, fn, *args, label: str = "llm", circuit: str = None, **kwargs):
+        """
+        串流版本（async）：fn(*args, **kwargs) 回傳 async iterator，或 await 之後才得到 async iterator
+        （例如 client.aio.models.generate_content_stream）。重試規則與 stream 相同。
+        """
+        breaker = get_circuit_breaker(circuit) if circuit else None
+        semaphore = self._async_semaphore()
+        attempt = 0
+        while True:
+            probe = breaker.before_call() if breaker is not None else False
+            try:
+                async with semaphore:
+                    started = time.perf_counter()
+                    received = False
+                    last = None
+                    try:
+                        stream = fn(*args, **kwargs)
+                        if inspect.isawaitable(stream):
+                            stream = await stream
+                        async for chunk in stream:
+                            received = True
+                            last = chunk
+                            yield chunk
+                    except Exception as e:
+                        delay = self._retry_delay(e, label, self.max_retries if received else attempt, breaker, started)
+                        if delay is None:
+                            raise
+                    else:
+                        self._record_success(last, label, breaker, started)
+                        return
+            finally:
+                if probe:
+                    breaker.release_probe()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+_lock = threading.Lock()
+_llm_client = None
+_genai_clients = {}
+_http_session = None
+_async_http_clients = weakref.WeakKeyDictionary()
+_async_openai_clients = weakref.WeakKeyDictionary()
+
+
+def get_llm_client() -> LLMClient:
+    """整個行程共用的 LLMClient（共用 semaphore 與統計）"""
+    global _llm_client
+    with _lock:
+        if _llm_client is None:
+            _llm_client = LLMClient()
+        return _llm_client
+
+
+def get_genai_client(api_key: str = None):
+    """共用的 google-genai Client；同一把金鑰只建立一次，底層 HTTP 連線會被重複使用"""
+    from google import genai
+
+    api_key = api_key or os.getenv("GEMINI_API_KEY")
+    with _lock:
+        if api_key not in _genai_clients:
+            _genai_clients[api_key] = genai.Client(api_key=api_key)
+        return _genai_clients[api_key]
+
+
+def get_http_session():
+    """共用的 requests.Session，連線池大小與最大併發數一致"""
+    global _http_session
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with _lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENCY)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+
+def get_async_http_client():
+    """目前 event loop 共用的 httpx.AsyncClient（連線無法跨 event loop 使用，因此每個 loop 各一個）"""
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if loop not in _async_http_clients:
+            limits = httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY)
+            _async_http_clients[loop] = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(60.0))
+        return _async_http_clients[loop]
+
+
+def get_async_openai_client(api_key: str = None):
+    """目前 event loop 共用的 AsyncOpenAI client"""
+    from openai import AsyncOpenAI
+
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_openai_clients.setdefault(loop, {})
+        if api_key not in clients:
+            clients[api_key] = AsyncOpenAI(api_key=api_key, max_retries=0)
+        return clients[api_key]
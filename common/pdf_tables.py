@@ -0,0 +1,58 @@
+import numbers
+
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.platypus import Paragraph, Table, TableStyle
+
+# 大型表格分段產生：每 chunk_rows 列一個 Table，每段都重複表頭。
+# ReportLab 只需要排版小表格，數千列的班級報告也能在有限記憶體內以接近線性的時間完成。
+
+DEFAULT_CHUNK_ROWS = 200
+SHORT_TEXT_LENGTH = 24
+CELL_PADDING = 12  # TableStyle 預設左右 padding 各 6pt
+
+
+def _cell(value, cell_style, short_text_length, width=None):
+    """
+    數字直接用字串；文字只有在單行寬度放得進欄寬時才用字串，否則包成 Paragraph 以便自動換行。
+    未指定欄寬（由 Table 自動決定）時，以 short_text_length 字數判斷。
+    """
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    if isinstance(value, numbers.Number):
+        return str(value)
+    text = str(value)
+    if "\n" not in text:
+        if width is None:
+            if len(text) <= short_text_length:
+                return text
+        elif stringWidth(text, cell_style.fontName, cell_style.fontSize) <= width - CELL_PADDING:
+            return text
+    return Paragraph(text.replace("\n", "<br/>"), cell_style)
+
+
+def build_table_chunks(df, style_commands: list, cell_style, available_width: float = None,
+                       col_widths: list = None, chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                       short_text_length: int = SHORT_TEXT_LENGTH):
+    """
+    將 DataFrame 轉成多個 Table flowable 的 list。
+    - style_commands：TableStyle 指令，套用到每一段（第 0 列為表頭）
+    - cell_style：需換行的文字 Paragraph 使用的樣式，也用來量測文字寬度
+    - available_width / col_widths：各段必須使用相同欄寬才會對齊；
+      未指定 col_widths 時以 available_width 平均分配
+    """
+    if col_widths is None and available_width is not None and len(df.columns):
+        col_widths = [available_width / len(df.columns)] * len(df.columns)
+
+    widths = col_widths or [None] * len(df.columns)
+    header = [_cell(col, cell_style, short_text_length, w) for col, w in zip(df.columns, widths)]
+    style = TableStyle(style_commands)
+    tables = []
+    for start in range(0, max(len(df), 1), chunk_rows):
+        rows = df.iloc[start:start + chunk_rows].itertuples(index=False, name=None)
+        data = [header] + [
+            [_cell(v, cell_style, short_text_length, w) for v, w in zip(row, widths)] for row in rows
+        ]
+        table = Table(data, colWidths=col_widths, repeatRows=1)
+        table.setStyle(style)
+        tables.append(table)
+    return tables
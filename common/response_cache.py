@@ -0,0 +1,82 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """
+    以 SQLite 存在硬碟上的 LLM 回應快取（content-addressed）。
+    - key 由模型名稱、提示模板、ITEMS 與逐字稿內容一起雜湊而成
+    - 超過 max_entries 筆時，依最後使用時間淘汰最久未用的資料（LRU）
+    重跑或遇到重複的逐字稿時直接回傳快取結果，不再呼叫 API。
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON responses(last_used)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, prompt: str, items: list, dialogue: str) -> str:
+        payload = json.dumps([model, prompt, list(items), dialogue], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys) -> dict:
+        """
+        一次查詢多個 key，回傳 {key: value}（只包含命中的 key）。
+        以 SELECT ... IN 分段查詢，命中項目的 last_used 在同一個交易中更新，整批只 commit 一次。
+        """
+        keys = list(dict.fromkeys(key for key in keys if key is not None))
+        found = {}
+        if not keys:
+            return found
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, value FROM responses WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+            if found:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE responses SET last_used = ? WHERE key = ?", [(now, key) for key in found]
+                )
+                self.conn.commit()
+        return found
+
+    def set(self, key: str, value: dict):
+        with self.lock:
+            exists = self.conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, last_used) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), time.time()),
+            )
+            if exists is None:
+                self.size += 1
+            if self.size > self.max_entries:
+                overflow = self.size - self.max_entries
+                self.conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self.size -= overflow
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,144 @@
+import json
+
+from common.batching import BatchMismatchError
+from common.json_mode import request_json_rows, strip_code_fence
+from common.llm_client import get_llm_client
+from common.response_cache import ResponseCache
+
+DIALOGUE_COLUMNS = ["text", "utterance", "content", "dialogue", "Dialogue"]
+
+
+def select_dialogue_column(chunk) -> str:
+    """
+    根據 CSV 欄位自動選取存放逐字稿的欄位。
+    優先檢查常見欄位名稱（DIALOGUE_COLUMNS），若都不存在則回傳第一個欄位。
+    """
+    for col in DIALOGUE_COLUMNS:
+        if col in chunk.columns:
+            return col
+    print("⚠️ 找不到預設欄位，將使用第一個欄位：", list(chunk.columns))
+    return chunk.columns[0]
+
+
+def response_text_of(response) -> str:
+    return response.text if hasattr(response, "text") else response.candidates[0].content.parts[0].text
+
+
+class TranscriptCoder:
+    """
+    DRai.py 與 groupfinal 逐字稿編碼共用的批次編碼流程，各專案只提供模型、ITEMS 與提示：
+    - code_batch：多筆逐字稿以 delimiter 合併成一次請求，回覆同樣以 delimiter 切開
+    - code_batch_json：要求單一 JSON 陣列、逐筆帶 index，只重送缺漏或驗證失敗的筆數
+    有 cache 時先查快取，只送出尚未編碼的逐字稿；limiter 只在真正呼叫 API 前取得令牌。
+    """
+
+    def __init__(self, model: str, items: list, prompt: str, json_prompt: str, allowed_values: tuple,
+                 label: str = "coder", delimiter: str = "-----"):
+        self.model = model
+        self.items = items
+        self.prompt = prompt
+        self.json_prompt = json_prompt
+        self.allowed_values = allowed_values
+        self.label = label
+        self.delimiter = delimiter
+
+    def empty_result(self) -> dict:
+        return {item: "" for item in self.items}
+
+    def parse_response(self, response_text: str):
+        """
+        解析單筆 JSON 回覆（可被 markdown 反引號包圍），缺少的項目補空字串。
+        回傳 (result, ok)；解析失敗時 result 各項皆為空、ok 為 False（不寫入快取）
+        """
+        try:
+            result = json.loads(strip_code_fence(response_text))
+            for item in self.items:
+                if item not in result:
+                    result[item] = ""
+            return result, True
+        except Exception as e:
+            print(f"⚠️ 解析 JSON 失敗：{e}")
+            print("原始回傳內容：", response_text)
+            return self.empty_result(), False
+
+    def _lookup_cache(self, cache: ResponseCache, prompt: str, dialogues: list):
+        """查詢快取，回傳 (results, keys, pending)；pending 為尚未編碼的逐字稿位置"""
+        results = [None] * len(dialogues)
+        keys = [None] * len(dialogues)
+        if cache is not None:
+            keys = [ResponseCache.make_key(self.model, prompt, self.items, dialogue) for dialogue in dialogues]
+            hits = cache.get_many(keys)
+            results = [hits.get(key) for key in keys]
+        pending = [i for i, res in enumerate(results) if res is None]
+        if not pending:
+            print(f"♻️ 批次 {len(dialogues)} 筆皆命中快取")
+        return results, keys, pending
+
+    def _generate(self, client, contents: str, limiter=None) -> str:
+        if limiter is not None:
+            limiter.acquire()
+        response = get_llm_client().call(
+            client.models.generate_content,
+            model=self.model,
+            contents=contents,
+            label=self.label
+        )
+        response_text = response_text_of(response)
+        print("✅ 批次 API 回傳內容：", response_text)
+        return response_text
+
+    def code_batch(self, client, dialogues: list, cache: ResponseCache = None, limiter=None,
+                   strict: bool = False) -> list:
+        """
+        delimiter 模式；回傳與 dialogues 等長的結果。
+        筆數對得上且解析成功的結果才寫入快取，避免錯位的結果被重複使用；
+        strict=True 時筆數不符會丟出 BatchMismatchError，交由呼叫端拆批重送。
+        """
+        results, keys, pending = self._lookup_cache(cache, self.prompt, dialogues)
+        if not pending:
+            return results
+
+        batch_text = f"\n{self.delimiter}\n".join(dialogues[i] for i in pending)
+        try:
+            response_text = self._generate(client, self.prompt + "\n\n" + batch_text, limiter)
+        except Exception as e:
+            print(f"❌ API 呼叫失敗：{e}")
+            for i in pending:
+                results[i] = self.empty_result()
+            return results
+
+        parsed = [self.parse_response(part) for part in response_text.split(self.delimiter) if part.strip()]
+        aligned = len(parsed) == len(pending)
+        if strict and not aligned:
+            raise BatchMismatchError(f"送出 {len(pending)} 筆，回傳 {len(parsed)} 筆")
+        # 結果多於送出筆數時只取前面對應的部分，不足時補空結果
+        while len(parsed) < len(pending):
+            parsed.append((self.empty_result(), False))
+        for i, (result, ok) in zip(pending, parsed[:len(pending)]):
+            results[i] = result
+            if cache is not None and aligned and ok:
+                cache.set(keys[i], result)
+        return results
+
+    def code_batch_json(self, client, dialogues: list, cache: ResponseCache = None, limiter=None) -> list:
+        """JSON 陣列模式；多次請求後仍缺漏的筆數回傳空結果"""
+        results, keys, pending = self._lookup_cache(cache, self.json_prompt, dialogues)
+        if not pending:
+            return results
+
+        def send(indexed_text):
+            try:
+                return self._generate(client, self.json_prompt + "\n\n" + indexed_text, limiter)
+            except Exception as e:
+                print(f"❌ API 呼叫失敗：{e}")
+                return None
+
+        rows = request_json_rows(send, [dialogues[i] for i in pending], self.items, self.allowed_values)
+        for i, row in zip(pending, rows):
+            if row is None:
+                results[i] = self.empty_result()
+                continue
+            results[i] = row
+            if cache is not None:
+                cache.set(keys[i], row)
+        return results
@@ -8,6 +8,10 @@ import os
 from dotenv import load_dotenv
 from google import genai
 from reportlab.lib.styles import ParagraphStyle
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.pdf_tables import build_table_chunks
 
 def create_pdf_from_csv(csv_file, pdf_file):
     df = pd.read_csv(csv_file)
@@ -20,15 +24,8 @@ def create_pdf_from_csv(csv_file, pdf_file):
     elements.append(title)
     elements.append(Spacer(1, 12))
 
-    data = [df.columns.tolist()] + df.values.tolist()
-
-    formatted_data = []
-    for row in data:
-        formatted_row = [Paragraph(str(cell), styles["Normal"]) for cell in row]
-        formatted_data.append(formatted_row)
-
-    table = Table(formatted_data, repeatRows=1)
-    table.setStyle(TableStyle([
+    # 分段建表：每段固定列數並重複表頭，避免一次排版整張大表
+    elements.extend(build_table_chunks(df, [
     ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#e1e7f0")),
     ("TEXTCOLOR", (0, 0), (-1, 0), colors.whitesmoke),
     ("ALIGN", (0, 0), (-1, -1), "LEFT"),
@@ -39,9 +36,7 @@ def create_pdf_from_csv(csv_file, pdf_file):
     ("TOPPADDING", (0, 0), (-1, -1), 6),
     ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
     ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.lightgrey]),
-]))  
-
-    elements.append(table)
+], styles["Normal"], available_width=doc.width))
     doc.build(elements)
     print(f"✅ PDF 產出成功：{pdf_file}")
 
@@ -1,17 +1,48 @@
-from flask import Flask, render_template, request, send_from_directory
+from flask import Flask, render_template, request, send_from_directory, jsonify, abort
 import pandas as pd
 import os
-from modules.classifier import classify_students
-from modules.pdf_generator import generate_class_pdf, generate_student_pdf
+import sys
+import json
+import uuid
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from modules.classifier import classify_students, class_skill_profile
+from modules.pdf_generator import generate_class_pdf, generate_student_pdf, shutdown_render_pool
 from modules.posttest_suggester import generate_posttest_transcript
+from modules.jobs import JobStore, JobQueue
+from modules.student_store import StudentStore, student_fingerprint
+from modules.analyzer import rank_skills
+from modules.suggestion_batch import chunked, request_batch_suggestions
 from google.generativeai import GenerativeModel
 from google.api_core.exceptions import GoogleAPIError
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.llm_client import get_llm_client
+from common.circuit_breaker import CircuitOpenError
+
 app = Flask(__name__)
 
 # 初始化 Gemini 模型
 model = GenerativeModel("gemini-1.5-flash-8b")
 
+# 學生建議的併發上限（所有請求共用同一個執行緒池，避免同時上傳時無限制地開執行緒）
+SUGGESTION_WORKERS = int(os.getenv("SUGGESTION_WORKERS", "8"))
+suggestion_executor = ThreadPoolExecutor(max_workers=SUGGESTION_WORKERS)
+
+# 背景工作：狀態存在 SQLite，由 JOB_WORKERS 個執行緒處理
+UPLOAD_FOLDER = "uploads"
+REPORT_ROOT = "static/reports"
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+job_store = JobStore(os.getenv("JOB_DB_PATH", "jobs.sqlite"))
+
+# 增量重建：成績沒變的學生沿用上次的建議，內容沒變的 PDF 分片直接沿用
+# 修改學生建議 prompt 時請一併更新 SUGGESTION_VERSION，讓舊建議失效
+SUGGESTION_VERSION = "student_suggestion/v1"
+SHARD_CACHE_DIR = os.getenv("SHARD_CACHE_DIR", "shard_cache")
+student_store = StudentStore(os.getenv("STUDENT_DB_PATH", "students.sqlite"))
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -22,75 +53,253 @@ def analyze():
     if not uploaded_file:
         return "未上傳檔案", 400
 
-    df = pd.read_csv(uploaded_file)
-    df_classified = classify_students(df)
+    # 先存下上傳檔並排入背景工作，立即回傳 job id，由前端輪詢 /jobs/<id>
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    csv_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}.csv")
+    uploaded_file.save(csv_path)
 
     # 取得使用者勾選項目
-    do_class_report = 'option_class' in request.form
-    do_student_report = 'option_student' in request.form
-    do_posttest = 'option_posttest' in request.form
+    options = {
+        "csv_path": csv_path,
+        "do_class_report": 'option_class' in request.form,
+        "do_student_report": 'option_student' in request.form,
+        "do_posttest": 'option_posttest' in request.form,
+    }
+    job_id = job_queue.submit(options)
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"job_id": job_id}), 202
+    return render_template("job.html", job_id=job_id), 202
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        abort(404)
+    job.pop("options", None)
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/result")
+def job_result(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        abort(404)
+    if job["status"] != "done":
+        return render_template("job.html", job_id=job_id), 202
+    result = job["result"] or {}
+    return render_template("result.html", files=result.get("files", []), transcript=result.get("transcript", ""))
+
+# 同一份報告同時只允許一個工作產生，避免兩個相同上傳互相覆寫
+# {key: [lock, 使用中的工作數]}，最後一個工作結束時移除，字典不會隨上傳次數增長
+_report_locks = {}
+_report_locks_guard = threading.Lock()
+
+@contextmanager
+def report_lock(key):
+    with _report_locks_guard:
+        entry = _report_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _report_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _report_locks[key]
+
+def report_key(options):
+    """上傳 CSV 內容 + 勾選項目的雜湊，作為報告輸出資料夾名稱"""
+    digest = hashlib.sha256()
+    with open(options["csv_path"], "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    flags = {key: options[key] for key in ("do_class_report", "do_student_report", "do_posttest")}
+    digest.update(json.dumps(flags, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+def run_analysis(options, report):
+    """
+    背景工作：分班、產生 PDF 與各項建議，回傳 {"files": [...], "transcript": "..."}。
+    每份報告輸出到 static/reports/<雜湊>/，內容與勾選項目相同時直接沿用既有結果。
+    只有完整的報告（沒有任何建議是錯誤訊息或預設文字）才寫入 result.json 供之後沿用。
+    工作結束（成功或失敗）後刪除上傳的 CSV。
+    """
+    try:
+        return build_or_reuse_reports(options, report)
+    finally:
+        try:
+            os.remove(options["csv_path"])
+        except OSError:
+            pass
+
+def build_or_reuse_reports(options, report):
+    key = report_key(options)
+    with report_lock(key):
+        out_dir = os.path.join(REPORT_ROOT, key)
+        manifest_path = os.path.join(out_dir, "result.json")
+        if os.path.exists(manifest_path):
+            report("沿用既有報告", 1)
+            with open(manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        os.makedirs(out_dir, exist_ok=True)
+        result, complete = build_reports(options, out_dir, key, report)
+        if not complete:
+            print(f"⚠️ 報告 {key} 含有預設建議，不寫入 result.json，下次重新產生")
+            return result
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(tmp_path, manifest_path)
+        return result
+
+def is_fallback(text):
+    # 與 StudentStore 相同的規則：錯誤訊息與預設建議都以 ⚠️ 開頭
+    return text.startswith("⚠️")
+
+def build_reports(options, out_dir, key, report):
+    """回傳 (result, complete)；complete 為 False 表示有建議或後測建議是錯誤訊息／預設文字"""
+    report("讀取與分班", 0.05)
+    df = pd.read_csv(options["csv_path"])
+    df_classified = classify_students(df)
+    # 各班統計只算一次，分班報告 PDF 與後測建議共用
+    profile = class_skill_profile(df_classified)
 
     files = []
     transcript = ""
+    complete = True
+
+    if options["do_class_report"]:
+        report("產生分班報告", 0.1)
+        generate_class_pdf(df_classified, os.path.join(out_dir, "class_assignment_report.pdf"), profile=profile)
+        files.append(f"{key}/class_assignment_report.pdf")
 
-    if do_class_report:
-        generate_class_pdf(df_classified, "static/reports/class_assignment_report.pdf")
-        files.append("class_assignment_report.pdf")
+    if options["do_student_report"]:
+        def on_progress(done, total):
+            report(f"產生學生建議（{done}/{total}）", 0.15 + 0.65 * done / max(total, 1))
 
-    if do_student_report:
         analysis_list = []
-        for _, row in df_classified.iterrows():
+        suggestions = generate_student_suggestions(df_classified, on_progress=on_progress, store=student_store)
+        complete = complete and not any(is_fallback(suggestion) for suggestion in suggestions)
+        ranked = rank_skills(df_classified, sep="、")
+        for row, strengths, weaknesses, suggestion in zip(
+            df_classified.to_dict("records"), ranked["強項"], ranked["弱項"], suggestions
+        ):
             entry = {
                 "姓名": row["姓名"],
                 "聽力": row["聽力成績"],
                 "口說": row["口說成績"],
                 "閱讀": row["閱讀成績"],
                 "寫作": row["寫作成績"],
-                "強項": get_strong_skills(row),
-                "弱項": get_weak_skills(row),
-                "建議": generate_student_suggestion(row)
+                "強項": strengths,
+                "弱項": weaknesses,
+                "建議": suggestion
             }
             analysis_list.append(entry)
-        generate_student_pdf(analysis_list, "static/reports/student_feedback_report.pdf")
-        files.append("student_feedback_report.pdf")
+        report("產生學生建議 PDF", 0.85)
+        generate_student_pdf(analysis_list, os.path.join(out_dir, "student_feedback_report.pdf"),
+                             shard_cache_dir=SHARD_CACHE_DIR)
+        files.append(f"{key}/student_feedback_report.pdf")
 
-    if do_posttest:
-        transcript = generate_posttest_transcript(df_classified)
+    if options["do_posttest"]:
+        report("產生後測建議", 0.9)
+        transcript = generate_posttest_transcript(df_classified, profile=profile)
+        complete = complete and not is_fallback(transcript)
 
-    return render_template("result.html", files=files, transcript=transcript)
+    return {"files": files, "transcript": transcript}, complete
 
 @app.route('/download/<path:filename>')
 def download_file(filename):
-    return send_from_directory("static/reports", filename, as_attachment=True)
+    # 以檔案串流回傳，支援 ETag / If-None-Match 與 Range（大型 PDF 可續傳、分段下載）
+    # 不設 max_age（no-cache）：含預設建議的報告會在同一路徑重新產生，瀏覽器每次都需以 ETag 重新驗證
+    return send_from_directory(
+        REPORT_ROOT, filename, as_attachment=True,
+        conditional=True, etag=True
+    )
+
+# 併發產生全班的學生建議，回傳順序與 df 的列順序相同
+# 有 store 時，成績沒變的學生直接沿用既有建議，只替有變動的學生呼叫 LLM
+# 需要產生的學生每 SUGGESTION_BATCH_SIZE 位合併成一次請求，各批次平行送出
+def generate_student_suggestions(df, on_progress=None, store=None):
+    rows = [row for _, row in df.iterrows()]
+    fingerprints = [student_fingerprint(row, SUGGESTION_VERSION) for row in rows]
+    cached = store.get_many(fingerprints) if store is not None else {}
+    suggestions = [cached.get(fp) for fp in fingerprints]
+    pending = [i for i, fp in enumerate(fingerprints) if fp not in cached]
 
-# 工具函式
-def get_strong_skills(row):
-    skills = {"聽力": row["聽力成績"], "口說": row["口說成績"],
-              "閱讀": row["閱讀成績"], "寫作": row["寫作成績"]}
-    return "、".join(sorted(skills, key=skills.get, reverse=True)[:2])
+    done = len(rows) - len(pending)
+    fresh = {}
+    batches = list(chunked(pending))
+    for batch, results in zip(batches, suggestion_executor.map(
+        generate_suggestion_batch, [[rows[i] for i in batch] for batch in batches]
+    )):
+        for i, suggestion in zip(batch, results):
+            suggestions[i] = suggestion
+            # 錯誤訊息與預設建議不寫入，下次重新產生
+            if not suggestion.startswith("⚠️"):
+                fresh[fingerprints[i]] = suggestion
+        done += len(batch)
+        if on_progress is not None:
+            on_progress(done, len(rows))
+    if store is not None:
+        store.set_many(fresh)
+    return suggestions
 
-def get_weak_skills(row):
-    skills = {"聽力": row["聽力成績"], "口說": row["口說成績"],
-              "閱讀": row["閱讀成績"], "寫作": row["寫作成績"]}
-    return "、".join(sorted(skills, key=skills.get)[:2])
+SUGGESTION_HEADER = "你是一位日語教學專家，請針對以下學生的成績，給出具體學習建議"
+SUGGESTION_FORMAT = "請使用清楚段落說明其學習強項、弱點與改善策略，不需說明格式，只需建議內容。"
+
+def student_profile(row):
+    return (
+        f"姓名：{row['姓名']}\n"
+        f"聽力：{row['聽力成績']}\n口說：{row['口說成績']}\n"
+        f"閱讀：{row['閱讀成績']}\n寫作：{row['寫作成績']}"
+    )
+
+# 多位學生合併成一次請求；批次回覆中缺漏的學生才逐一呼叫
+def generate_suggestion_batch(rows):
+    if len(rows) == 1:
+        return [generate_student_suggestion(rows[0])]
+    header = f"{SUGGESTION_HEADER}（每位學生各自一段）。{SUGGESTION_FORMAT}"
+    results = request_batch_suggestions(model, header, [student_profile(row) for row in rows],
+                                        label="student_suggestion_batch")
+    missing = [i for i, suggestion in enumerate(results) if suggestion is None]
+    if missing:
+        print(f"⚠️ 批次建議缺少 {len(missing)} 位學生，改為逐一產生")
+    for i in missing:
+        results[i] = generate_student_suggestion(rows[i])
+    return results
 
 # 學生個別建議產生
 def generate_student_suggestion(row):
     try:
-        prompt = (
-            f"你是一位日語教學專家，請針對以下學生的成績，給出具體學習建議：\n\n"
-            f"姓名：{row['姓名']}\n"
-            f"聽力：{row['聽力成績']}\n口說：{row['口說成績']}\n"
-            f"閱讀：{row['閱讀成績']}\n寫作：{row['寫作成績']}\n\n"
-            f"請使用清楚段落說明其學習強項、弱點與改善策略，不需說明格式，只需建議內容。"
-        )
-        response = model.generate_content(prompt)
+        prompt = f"{SUGGESTION_HEADER}：\n\n{student_profile(row)}\n\n{SUGGESTION_FORMAT}"
+        response = get_llm_client().call(model.generate_content, prompt, label="student_suggestion", circuit="gemini")
         return response.text.strip() if response and response.text else "⚠️ 無建議內容"
-    except GoogleAPIError as e:
+    except (GoogleAPIError, CircuitOpenError) as e:
         print("⚠️ Gemini API 錯誤：", str(e))
         return "⚠️ 由於建議產生額度已滿，請稍後再試。以下為預設建議：請加強練習弱項技能，並多利用教材進行自我檢測。"
     except Exception as e:
         return f"⚠️ 產生建議時發生錯誤：{e}"
 
+job_queue = JobQueue(job_store, run_analysis, max_workers=JOB_WORKERS)
+
+# 未完成的工作在第一個請求時才恢復：debug 模式的 reloader 會在父行程與服務行程各載入一次本模組，
+# 只有實際處理請求的服務行程會執行到這裡
+_resume_lock = threading.Lock()
+_resumed = False
+
+@app.before_request
+def resume_unfinished_jobs():
+    global _resumed
+    if _resumed:
+        return
+    with _resume_lock:
+        if not _resumed:
+            _resumed = True
+            job_queue.resume_unfinished()
+
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    try:
+        app.run(debug=True)
+    finally:
+        shutdown_render_pool()
\ No newline at end of file
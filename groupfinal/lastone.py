@@ -1,12 +1,10 @@
 import asyncio
 import sys
-from google import genai
 import os
 import json
 import time
 import pandas as pd
 from dotenv import load_dotenv
-from google import genai
 from reportlab.lib.pagesizes import A4, landscape
 from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet
@@ -14,161 +12,62 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib import colors
 from reportlab.lib.styles import ParagraphStyle
 
-# === 設定 ===
-csv_file_path = "japanese_pretest.csv"
-jlpt_file_path = "japanese_learning_info.csv"
-chunk_size = 1000
-batch_size = 12
-delimiter = "-----"
+from modules.transcript_coder import (
+    ITEMS, classify_and_export, iter_coded_batches, make_sizer, open_cache, frame_fingerprint
+)
 
-ITEMS = [
-]
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.checkpoint import BatchCheckpoint
+from common.llm_client import get_genai_client
+from common.pdf_tables import build_table_chunks
+from common.transcript_coding import select_dialogue_column
 
 # === 載入 API Key ===
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# === JSON Parse Function ===
-def parse_response(response_text):
-    cleaned = response_text.strip()
-    if cleaned.startswith("```"):
-        lines = cleaned.splitlines()
-        if lines[0].startswith("```"):
-            lines = lines[1:]
-        if lines and lines[-1].strip() == "```":
-            lines = lines[:-1]
-        cleaned = "\n".join(lines).strip()
-
-    try:
-        result = json.loads(cleaned)
-        for item in ITEMS:
-            if item not in result:
-                result[item] = ""
-        return result
-    except Exception as e:
-        print(f"⚠️ 解析 JSON 失敗：{e}")
-        print("原始回傳內容：", response_text)
-        return {item: "" for item in ITEMS}
-
-# === Dialogue Column Detection ===
-def select_dialogue_column(chunk: pd.DataFrame) -> str:
-    preferred = ["text", "utterance", "content", "dialogue", "Dialogue"]
-    for col in preferred:
-        if col in chunk.columns:
-            return col
-    print("⚠️ 找不到預設欄位，將使用第一個欄位：", list(chunk.columns))
-    return chunk.columns[0]
-
-# === Classify by Score ===
-def classify_level(score):
-    if score < 45:
-        return "Beginner"
-    elif 45 <= score < 55:
-        return "Intermediate"
-    else:
-        return "Advanced"
-
-# === 將學生分級並輸出分類結果 ===
-def classify_and_export():
-    pretest_df = pd.read_csv(csv_file_path)
-    jlpt_df = pd.read_csv(jlpt_file_path)
-    merged_df = pd.merge(pretest_df, jlpt_df, on="StudentID")
-    merged_df["Class_Level"] = merged_df["Total_Score"].apply(classify_level)
-
-    class_groups = {
-        "Beginner": merged_df[merged_df["Class_Level"] == "Beginner"],
-        "Intermediate": merged_df[merged_df["Class_Level"] == "Intermediate"],
-        "Advanced": merged_df[merged_df["Class_Level"] == "Advanced"]
-    }
-
-    for level, df in class_groups.items():
-        filename = f"class_{level.lower()}.csv"
-        df.to_csv(filename, index=False)
-
-    return merged_df
-
-# === 批次分析逐字稿 ===
-def process_batch_dialogue(client, dialogues: list):
-    prompt = (
-        "你是一位日文教學專家，請根據以下編碼規則評估是否與日語教學的目標相同：\n"
-        + "\n".join(ITEMS) +
-        "\n\n請依據評估結果，對每個項目：若觸及則標記為 Yes，否則標記為 No。"
-        "請對每筆逐字稿產生 JSON 格式回覆，並在各筆結果間用下列分隔線隔開：\n"
-        f"{delimiter}\n"
-        "例如：\n"
-        "```json\n"
-        "{ \"Vocab\": \"Yes\", \"Listening\": \"No\", ... }\n"
-        f"{delimiter}\n"
-        "{...}\n```"
-    )
-
-    batch_text = f"\n{delimiter}\n".join(dialogues)
-    content = prompt + "\n\n" + batch_text
-
-    try:
-        response = client.generate_content(
-            model="models/gemini-1.5-flash-latest",
-            contents=[{"role": "user", "parts": [content]}]
-        )
-    except Exception as e:
-        print(f"❌ API 呼叫失敗：{e}")
-        return [{item: "" for item in ITEMS} for _ in dialogues]
-
-    response_text = response.text if hasattr(response, "text") else response.candidates[0].content.parts[0].text
-    print("✅ 批次 API 回傳內容：", response_text)
-
-    parts = response_text.split(delimiter)
-    results = []
-    for part in parts:
-        part = part.strip()
-        if part:
-            results.append(parse_response(part))
-
-    while len(results) < len(dialogues):
-        results.append({item: "" for item in ITEMS})
-    return results[:len(dialogues)]
-
 # === 主程式 ===
 if __name__ == "__main__":
     # === Part 1: 學生分級 ===
-    merged_df = classify_and_export()
+    # 分級結果直接以記憶體中的 DataFrame 交給編碼流程；--no-export 時不另外輸出 class_*.csv
+    merged_df, class_groups = classify_and_export(export_csv="--no-export" not in sys.argv[1:])
+    cache = open_cache()
+    # --resume：各級別都跳過上次已完成的批次
+    resume = "--resume" in sys.argv[1:]
 
     # === Part 2 & 3: 處理每個級別 ===
     for level in ["beginner", "intermediate", "advanced"]:
-        input_csv = f"class_{level}.csv"
         output_csv = f"output_{level}.csv"
 
-        if not os.path.exists(input_csv):
-            print(f"⚠️ 找不到檔案：{input_csv}")
+        df = class_groups.get(level.capitalize())
+        if df is None or df.empty:
+            print(f"⚠️ [{level.capitalize()}] 沒有學生資料")
             continue
 
-        df = pd.read_csv(input_csv)
         dialogue_col = select_dialogue_column(df)
         print(f"🔍 [{level.capitalize()}] 使用欄位作為逐字稿來源：{dialogue_col}")
 
-        if os.path.exists(output_csv):
-            os.remove(output_csv)
+        checkpoint = BatchCheckpoint(output_csv, resume=resume, input_id=frame_fingerprint(df))
 
         total = len(df)
-        for start_idx in range(0, total, batch_size):
-            end_idx = min(start_idx + batch_size, total)
-            batch = df.iloc[start_idx:end_idx]
-            dialogues = [str(d).strip() for d in batch[dialogue_col]]
-            batch_results = process_batch_dialogue(genai, dialogues)
-
+        sizer = make_sizer()
+        for start_idx, end_idx, batch, batch_results in iter_coded_batches(
+            get_genai_client(), [df], dialogue_col, sizer, cache=cache, start=checkpoint.rows_done
+        ):
             batch_df = batch.copy()
             for item in ITEMS:
                 batch_df[item] = [res.get(item, "") for res in batch_results]
 
-            mode = 'w' if start_idx == 0 else 'a'
-            header = (start_idx == 0)
-            batch_df.to_csv(output_csv, mode=mode, index=False, header=header, encoding="utf-8-sig")
+            checkpoint.write_batch(batch_df, start_idx, end_idx)
             print(f"✅ [{level.capitalize()}] 已處理 {end_idx}/{total} 筆資料")
 
             time.sleep(1)
 
+        checkpoint.finish()
         print(f"🎉 [{level.capitalize()}] 全部處理完成，結果儲存於：{output_csv}")
 
+    cache.close()
+
 
 def create_pdf_from_csv(csv_file, pdf_file):
     df = pd.read_csv(csv_file)
@@ -181,15 +80,8 @@ def create_pdf_from_csv(csv_file, pdf_file):
     elements.append(title)
     elements.append(Spacer(1, 12))
 
-    data = [df.columns.tolist()] + df.values.tolist()
-
-    formatted_data = []
-    for row in data:
-        formatted_row = [Paragraph(str(cell), styles["Normal"]) for cell in row]
-        formatted_data.append(formatted_row)
-
-    table = Table(formatted_data, repeatRows=1)
-    table.setStyle(TableStyle([
+    # 分段建表：每段固定列數並重複表頭，避免一次排版整張大表
+    elements.extend(build_table_chunks(df, [
     ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#e1e7f0")),
     ("TEXTCOLOR", (0, 0), (-1, 0), colors.whitesmoke),
     ("ALIGN", (0, 0), (-1, -1), "LEFT"),
@@ -200,9 +92,7 @@ def create_pdf_from_csv(csv_file, pdf_file):
     ("TOPPADDING", (0, 0), (-1, -1), 6),
     ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
     ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.lightgrey]),
-]))  
-
-    elements.append(table)
+], styles["Normal"], available_width=doc.width))
     doc.build(elements)
     print(f"✅ PDF 產出成功：{pdf_file}")
 
@@ -1,62 +1,117 @@
+import os
+import sys
+import numpy as np
 import pandas as pd
 from google.generativeai import GenerativeModel
 from google.api_core.exceptions import GoogleAPIError
 
-model = GenerativeModel("gemini-1.5-flash-8b")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from common.llm_client import get_llm_client
+from common.circuit_breaker import CircuitOpenError
+from modules.classifier import SKILLS, SCORE_COLUMNS
+from modules.student_store import student_fingerprint
+from modules.suggestion_batch import chunked, request_batch_suggestions
 
-def analyze_strengths_and_weaknesses(df):
-    results = []
+# 修改下方 prompt 時請更新版本，讓 StudentStore 中的舊建議失效
+PROMPT_VERSION = "analyzer/v1"
 
-    for _, row in df.iterrows():
-        name = row.get("姓名", "未命名")
-        scores = {
-            "聽力": row.get("聽力成績", 0),
-            "口說": row.get("口說成績", 0),
-            "閱讀": row.get("閱讀成績", 0),
-            "寫作": row.get("寫作成績", 0)
-        }
+model = GenerativeModel("gemini-1.5-flash-8b")
+
+# 技能名稱與對應的成績欄位
+SKILL_COLUMNS = dict(zip(SKILLS, SCORE_COLUMNS))
 
-        # 找出強弱項目
-        sorted_skills = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-        strengths = [s[0] for s in sorted_skills[:2]]
-        weaknesses = [s[0] for s in sorted_skills[-2:]]
+def rank_skills(df: pd.DataFrame, k: int = 2, sep: str = ", ") -> pd.DataFrame:
+    """
+    一次算出全班每位學生的前 k 強項與後 k 弱項（對成績矩陣做 argsort，不逐列排序）。
+    回傳與 df 同索引的「強項」「弱項」兩欄；強項由高到低、弱項由低到高，同分時依技能順序。
+    缺少的成績欄位視為 0。
+    """
+    names = np.array(list(SKILL_COLUMNS))
+    scores = (
+        df.reindex(columns=list(SKILL_COLUMNS.values()))
+        .apply(pd.to_numeric, errors="coerce")
+        .fillna(0)
+        .to_numpy(dtype=float)
+    )
+    top = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    bottom = np.argsort(scores, axis=1, kind="stable")[:, :k]
+    return pd.DataFrame({
+        "強項": [sep.join(row) for row in names[top]],
+        "弱項": [sep.join(row) for row in names[bottom]],
+    }, index=df.index)
 
-        # 建構 prompt 給 Gemini
-        prompt = f"""
+ANALYSIS_INSTRUCTIONS = """
 你是一位日語教師，請針對以下學生的語言能力分數，分析其學習優勢與劣勢，並提供針對性的學習建議。建議內容請涵蓋：
 - 強項技能可如何進階學習
 - 弱項技能可如何補強
 - 適合的教材或練習方式
 - 回應為簡潔段落
+"""
 
-學生資料：
-姓名：{name}
-聽力：{scores['聽力']}
-口說：{scores['口說']}
-閱讀：{scores['閱讀']}
-寫作：{scores['寫作']}
+def student_profile(entry: dict) -> str:
+    return (
+        f"姓名：{entry['姓名']}\n"
+        f"聽力：{entry['聽力']}\n"
+        f"口說：{entry['口說']}\n"
+        f"閱讀：{entry['閱讀']}\n"
+        f"寫作：{entry['寫作']}\n\n"
+        f"強項：{entry['強項']}\n"
+        f"弱項：{entry['弱項']}\n"
+    )
 
-強項：{', '.join(strengths)}
-弱項：{', '.join(weaknesses)}
-"""
+def suggest_one(entry: dict):
+    """單一學生呼叫一次 Gemini，回傳 (建議, 是否成功)"""
+    prompt = f"{ANALYSIS_INSTRUCTIONS}\n學生資料：\n{student_profile(entry)}"
+    try:
+        response = get_llm_client().call(model.generate_content, prompt, label="analyzer", circuit="gemini")
+        suggestion = response.text.strip() if response and response.text else ""
+        return suggestion, bool(suggestion)
+    except (GoogleAPIError, CircuitOpenError) as e:
+        return f"⚠️ API 錯誤：{e}", False
+    except Exception as e:
+        return f"⚠️ 建議產生失敗：{e}", False
 
-        try:
-            response = model.generate_content(prompt)
-            suggestion = response.text.strip() if response and response.text else ""
-        except GoogleAPIError as e:
-            suggestion = f"⚠️ API 錯誤：{e}"
-        except Exception as e:
-            suggestion = f"⚠️ 建議產生失敗：{e}"
+def analyze_strengths_and_weaknesses(df, store=None):
+    """
+    分析每位學生的強弱項並產生建議。
+    store（StudentStore）：成績沒變的學生直接沿用既有建議，不再呼叫 LLM
+    需要產生的學生每 SUGGESTION_BATCH_SIZE 位合併成一次請求，批次中缺漏的學生才逐一呼叫
+    """
+    records = df.to_dict("records")
+    fingerprints = [student_fingerprint(row, PROMPT_VERSION) for row in records]
+    cached = store.get_many(fingerprints) if store is not None else {}
+    fresh = {}
 
+    results = []
+    ranked = rank_skills(df)
+    for row, fingerprint, strengths, weaknesses in zip(records, fingerprints, ranked["強項"], ranked["弱項"]):
         results.append({
-            "姓名": name,
-            "聽力": scores['聽力'],
-            "口說": scores['口說'],
-            "閱讀": scores['閱讀'],
-            "寫作": scores['寫作'],
-            "強項": ", ".join(strengths),
-            "弱項": ", ".join(weaknesses),
-            "建議": suggestion
+            "姓名": row.get("姓名", "未命名"),
+            "聽力": row.get("聽力成績", 0),
+            "口說": row.get("口說成績", 0),
+            "閱讀": row.get("閱讀成績", 0),
+            "寫作": row.get("寫作成績", 0),
+            "強項": strengths,
+            "弱項": weaknesses,
+            "建議": cached.get(fingerprint)
         })
 
-    return results
\ No newline at end of file
+    pending = [i for i, entry in enumerate(results) if entry["建議"] is None]
+    for batch in chunked(pending):
+        suggestions = [None]
+        if len(batch) > 1:
+            header = f"{ANALYSIS_INSTRUCTIONS}\n請對每位學生各自提供一段建議。"
+            suggestions = request_batch_suggestions(
+                model, header, [student_profile(results[i]) for i in batch], label="analyzer_batch"
+            )
+        for i, suggestion in zip(batch, suggestions):
+            ok = suggestion is not None
+            if not ok:
+                suggestion, ok = suggest_one(results[i])
+            results[i]["建議"] = suggestion
+            if ok:
+                fresh[fingerprints[i]] = suggestion
+
+    if store is not None:
+        store.set_many(fresh)
+    return results
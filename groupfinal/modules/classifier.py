@@ -1,13 +1,26 @@
+import numpy as np
 import pandas as pd
 
-def classify(score):
-    """根據總分進行分級"""
-    if score < 45:
-        return "Beginner"
-    elif 45 <= score < 55:
-        return "Intermediate"
-    else:
-        return "Advanced"
+# 分級門檻：總分 < 45 為 Beginner、45 ~ 55 為 Intermediate、>= 55 為 Advanced
+LEVEL_THRESHOLDS = (45, 55)
+LEVEL_LABELS = ("Beginner", "Intermediate", "Advanced")
+
+# 四項技能與對應的成績欄位；強弱項分析與學生指紋也從這裡取用
+SKILLS = ("聽力", "口說", "閱讀", "寫作")
+SCORE_COLUMNS = tuple(f"{skill}成績" for skill in SKILLS)
+PROFILE_COLUMNS = {"count": "人數", "mean": "平均", "50%": "中位數", "std": "標準差", "25%": "P25", "75%": "P75"}
+
+def classify_scores(scores: pd.Series, thresholds=LEVEL_THRESHOLDS, labels=LEVEL_LABELS) -> pd.Series:
+    """
+    向量化分級：以 pd.cut 一次處理整欄分數，回傳 categorical 型別的等級欄位。
+    - thresholds：由小到大的分界分數，區間為左閉右開
+    - labels：各區間的等級名稱，數量需比 thresholds 多 1
+    分數缺值時等級也為缺值。
+    """
+    if len(labels) != len(thresholds) + 1:
+        raise ValueError("labels 數量必須比 thresholds 多 1")
+    bins = [-np.inf, *thresholds, np.inf]
+    return pd.cut(scores, bins=bins, labels=list(labels), right=False)
 
 def classify_students(df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -17,7 +30,19 @@ def classify_students(df: pd.DataFrame) -> pd.DataFrame:
     """
     if "總分" not in df.columns:
         # 若沒有總分，則以四項平均計算總分
-        df["總分"] = df[["聽力成績", "口說成績", "閱讀成績", "寫作成績"]].mean(axis=1)
+        df["總分"] = df[list(SCORE_COLUMNS)].mean(axis=1)
 
-    df["Class_Level"] = df["總分"].apply(classify)
-    return df
\ No newline at end of file
+    df["Class_Level"] = classify_scores(df["總分"])
+    return df
+
+def class_skill_profile(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    各班各技能的成績統計（人數、平均、中位數、標準差、P25、P75），以一次 groupby 算出。
+    回傳以 (Class_Level, 技能) 為索引的表格；呼叫端算一次後傳給分班報告 PDF 與後測建議共用，
+    兩者的 profile 參數即為此結果，未傳入時才自行計算。
+    """
+    stats = df.groupby("Class_Level", observed=True)[list(SCORE_COLUMNS)].describe(percentiles=[0.25, 0.5, 0.75])
+    profile = pd.concat(
+        [stats[column][list(PROFILE_COLUMNS)].assign(技能=skill) for skill, column in zip(SKILLS, SCORE_COLUMNS)]
+    ).rename(columns=PROFILE_COLUMNS)
+    return profile.set_index("技能", append=True).sort_index(level=0, sort_remaining=False)
@@ -0,0 +1,160 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# 背景工作佇列：工作狀態存在本機 SQLite，由執行緒池處理
+# 狀態：queued → running → done / failed
+# 執行中的工作記錄取走它的行程（owner）並定期更新 heartbeat；
+# 多個行程共用同一個資料庫時，只有 heartbeat 逾時（行程已結束）的工作才會被重新排隊
+
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "10"))
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "60"))
+
+class JobStore:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, stage TEXT, progress REAL DEFAULT 0, "
+            "options TEXT, result TEXT, error TEXT, created_at REAL, updated_at REAL, "
+            "owner TEXT, heartbeat REAL)"
+        )
+        # 舊版資料庫沒有 owner / heartbeat 欄位
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("owner", "TEXT"), ("heartbeat", "REAL")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self.conn.commit()
+
+    def create(self, options: dict) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO jobs (id, status, stage, progress, options, created_at, updated_at) "
+                "VALUES (?, 'queued', '排隊中', 0, ?, ?, ?)",
+                (job_id, json.dumps(options, ensure_ascii=False), now, now),
+            )
+            self.conn.commit()
+        return job_id
+
+    def update(self, job_id: str, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"], ensure_ascii=False)
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        with self.lock:
+            self.conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+            self.conn.commit()
+
+    def get(self, job_id: str):
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT id, status, stage, progress, options, result, error, created_at, updated_at "
+                "FROM jobs WHERE id = ?", (job_id,)
+            )
+            row = cur.fetchone()
+        if row is None:
+            return None
+        job = dict(zip([c[0] for c in cur.description], row))
+        job["options"] = json.loads(job["options"]) if job["options"] else {}
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def claim(self, job_id: str, owner: str) -> bool:
+        """把排隊中的工作原子地改為執行中；已被其他執行緒或行程取走時回傳 False"""
+        now = time.time()
+        with self.lock:
+            cur = self.conn.execute(
+                "UPDATE jobs SET status = 'running', stage = '開始處理', progress = 0, "
+                "owner = ?, heartbeat = ?, updated_at = ? WHERE id = ? AND status = 'queued'",
+                (owner, now, now, job_id),
+            )
+            self.conn.commit()
+        return cur.rowcount == 1
+
+    def heartbeat(self, owner: str):
+        """更新此行程所有執行中工作的 heartbeat"""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = 'running'",
+                (time.time(), owner),
+            )
+            self.conn.commit()
+
+    def requeue_stale(self, stale_after: float):
+        """把 heartbeat 超過 stale_after 秒沒更新的執行中工作改回排隊中；其他行程仍在執行的工作不受影響"""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'queued', stage = '重新排隊中', progress = 0, owner = NULL, updated_at = ? "
+                "WHERE status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)",
+                (time.time(), time.time() - stale_after),
+            )
+            self.conn.commit()
+
+    def queued(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+
+class JobQueue:
+    """
+    接收工作後立即回傳 job id，實際處理交給執行緒池。
+    handler(options, report) 為處理函式，report(stage, progress) 用來回報目前階段與進度（0 ~ 1），
+    回傳值會以 JSON 存成工作結果。
+    """
+
+    def __init__(self, store: JobStore, handler, max_workers: int = 2):
+        self.store = store
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.owner = uuid.uuid4().hex
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                self.store.heartbeat(self.owner)
+            except sqlite3.Error as e:
+                print(f"⚠️ 更新工作 heartbeat 失敗：{e}")
+
+    def submit(self, options: dict) -> str:
+        job_id = self.store.create(options)
+        self.executor.submit(self._run, job_id)
+        return job_id
+
+    def resume_unfinished(self):
+        """
+        伺服器重啟後，把上次尚未完成的工作重新排入佇列。
+        執行中的工作只有 heartbeat 逾時才重新排隊；排隊中的工作即使其他行程也排了，claim 只會讓一個行程執行
+        """
+        self.store.requeue_stale(JOB_STALE_AFTER)
+        for job_id in self.store.queued():
+            self.executor.submit(self._run, job_id)
+
+    def _run(self, job_id: str):
+        if not self.store.claim(job_id, self.owner):
+            return
+        job = self.store.get(job_id)
+
+        def report(stage: str, progress: float):
+            self.store.update(job_id, stage=stage, progress=round(progress, 3))
+
+        try:
+            result = self.handler(job["options"], report)
+        except Exception as e:
+            traceback.print_exc()
+            self.store.update(job_id, status="failed", stage="失敗", error=str(e))
+            return
+        self.store.update(job_id, status="done", stage="完成", progress=1, result=result)
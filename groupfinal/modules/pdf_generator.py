@@ -1,4 +1,14 @@
 import os
+import re
+import sys
+import json
+import uuid
+import hashlib
+import tempfile
+import threading
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, get_all_start_methods
 import pandas as pd
 from reportlab.lib.pagesizes import A4, landscape
 from reportlab.lib import colors
@@ -8,25 +18,86 @@ from reportlab.platypus import (
 )
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
 
-# 嘗試尋找系統中的中文字型
-def register_chinese_font():
-    font_path = os.path.join(os.path.dirname(__file__), "groupfinal/Noto_Sans_TC/NotoSansTC-VariableFont_wght.ttf")
-    if os.path.exists(font_path):
-        pdfmetrics.registerFont(TTFont("ChineseFont", font_path))
-        print("✅ 使用中文字型：NotoSansTC-VariableFont")
-    else:
-        raise FileNotFoundError(f"❌ 無法找到字型檔案：{font_path}")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from common.pdf_tables import build_table_chunks
+from modules.classifier import class_skill_profile
 
-register_chinese_font()
+# 合併分片 PDF 用；未安裝時學生報告改為單一行程輸出
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
 
-# 樣式設定
-styles = getSampleStyleSheet()
-styles.add(ParagraphStyle(name="ChineseTitle", fontName="ChineseFont", fontSize=16, leading=20))
-styles.add(ParagraphStyle(name="ChineseHeading", fontName="ChineseFont", fontSize=14, leading=18))
-styles.add(ParagraphStyle(name="Chinese", fontName="ChineseFont", fontSize=12, leading=15))
+# 學生報告平行輸出的行程數，以及啟用平行輸出的最少學生數（人數太少時開行程反而較慢）
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+PARALLEL_MIN_STUDENTS = int(os.getenv("PDF_PARALLEL_MIN_STUDENTS", "50"))
 
-def generate_class_pdf(df: pd.DataFrame, output_path: str):
+# 輸出用的行程池整個行程共用一個，第一次需要時才建立，由 shutdown_render_pool() 關閉
+# 呼叫端是多執行緒的 Flask 服務（持有 SQLite 連線與執行緒池），不可 fork，
+# 改用 forkserver（不支援時用 spawn）；子行程會重新 import 主程式，主程式的啟動流程需放在 __main__ 之下
+_pool_lock = threading.Lock()
+_render_pool = None
+
+def _get_render_pool() -> ProcessPoolExecutor:
+    global _render_pool
+    with _pool_lock:
+        if _render_pool is None:
+            method = "forkserver" if "forkserver" in get_all_start_methods() else "spawn"
+            _render_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=get_context(method))
+        return _render_pool
+
+def shutdown_render_pool():
+    """關閉共用的輸出行程池（伺服器結束時呼叫）"""
+    global _render_pool
+    with _pool_lock:
+        pool, _render_pool = _render_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+# 分片快取：每個分片的學生數，以及快取中最多保留的分片數
+SHARD_SIZE = int(os.getenv("PDF_SHARD_SIZE", "100"))
+SHARD_CACHE_MAX = int(os.getenv("PDF_SHARD_CACHE_MAX", "200"))
+
+# 中文字型設定：
+# - embed：嵌入 NotoSansTC（ReportLab 只會嵌入實際用到的字形子集）
+# - cid：使用 Adobe CID 字型 MSung-Light，不嵌入字型檔，PDF 最小、也不需字型檔
+# 找不到 TTF 時自動改用 cid
+FONT_NAME = "ChineseFont"
+FONT_MODE = os.getenv("PDF_FONT_MODE", "embed")
+FONT_PATH = os.getenv("PDF_FONT_PATH", os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "Noto_Sans_TC", "NotoSansTC-VariableFont_wght.ttf"))
+CID_FONT = "MSung-Light"
+
+_font_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def register_chinese_font() -> str:
+    """第一次產生 PDF 時才註冊字型（每個行程只做一次），回傳實際使用的字型名稱"""
+    with _font_lock:
+        if FONT_MODE != "cid" and os.path.exists(FONT_PATH):
+            pdfmetrics.registerFont(TTFont(FONT_NAME, FONT_PATH))
+            print("✅ 使用中文字型：NotoSansTC-VariableFont（子集嵌入）")
+            return FONT_NAME
+        if FONT_MODE != "cid":
+            print(f"⚠️ 無法找到字型檔案：{FONT_PATH}，改用內建 CID 字型 {CID_FONT}")
+        pdfmetrics.registerFont(UnicodeCIDFont(CID_FONT))
+        return CID_FONT
+
+@lru_cache(maxsize=1)
+def get_styles():
+    """樣式設定（延遲建立並快取）"""
+    font = register_chinese_font()
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name="ChineseTitle", fontName=font, fontSize=16, leading=20))
+    styles.add(ParagraphStyle(name="ChineseHeading", fontName=font, fontSize=14, leading=18))
+    styles.add(ParagraphStyle(name="Chinese", fontName=font, fontSize=12, leading=15))
+    return styles
+
+def generate_class_pdf(df: pd.DataFrame, output_path: str, profile: pd.DataFrame = None):
+    styles = get_styles()
     doc = SimpleDocTemplate(output_path, pagesize=landscape(A4))
     elements = []
 
@@ -34,72 +105,181 @@ def generate_class_pdf(df: pd.DataFrame, output_path: str):
     elements.append(title)
     elements.append(Spacer(1, 12))
 
-    data = [df.columns.tolist()] + df.values.tolist()
-    formatted_data = [[Paragraph(str(cell), styles["Chinese"]) for cell in row] for row in data]
-
-    table = Table(formatted_data, repeatRows=1)
-    table.setStyle(TableStyle([
+    table_style = [
         ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#e1e7f0")),
         ("TEXTCOLOR", (0, 0), (-1, 0), colors.whitesmoke),
         ("ALIGN", (0, 0), (-1, -1), "LEFT"),
         ("VALIGN", (0, 0), (-1, -1), "TOP"),
-        ("FONTNAME", (0, 0), (-1, -1), "ChineseFont"),
+        ("FONTNAME", (0, 0), (-1, -1), register_chinese_font()),
         ("FONTSIZE", (0, 0), (-1, -1), 10),
         ("BOTTOMPADDING", (0, 0), (-1, 0), 10),
         ("TOPPADDING", (0, 0), (-1, -1), 6),
         ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
         ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.whitesmoke, colors.lightgrey]),
-    ]))
+    ]
+
+    # 各班成績統計
+    if profile is None and "Class_Level" in df.columns:
+        profile = class_skill_profile(df)
+    if profile is not None:
+        stats = profile.reset_index()
+        stats["人數"] = stats["人數"].astype(int)
+        stats = stats.round(1)
+        elements.append(Paragraph("<b>各班成績統計</b>", styles["ChineseHeading"]))
+        elements.append(Spacer(1, 6))
+        elements.extend(build_table_chunks(stats, table_style, styles["Chinese"], available_width=doc.width))
+        elements.append(Spacer(1, 12))
+
+    # 分段建表：每段固定列數並重複表頭，短數值直接用字串
+    elements.extend(build_table_chunks(df, table_style, styles["Chinese"], available_width=doc.width))
 
-    elements.append(table)
     doc.build(elements)
     print(f"✅ 班級報告 PDF 已產出：{output_path}")
 
-def generate_student_pdf(analysis_results: list, output_path: str):
-    doc = SimpleDocTemplate(output_path, pagesize=A4)
+def _student_elements(entry: dict) -> list:
+    """單一學生的頁面內容（標題、分數表、強弱項與學習建議），結尾換頁"""
+    styles = get_styles()
     elements = []
+    name = entry.get("姓名", "未命名")
+    scores = {
+        "聽力": entry.get("聽力", ""),
+        "口說": entry.get("口說", ""),
+        "閱讀": entry.get("閱讀", ""),
+        "寫作": entry.get("寫作", "")
+    }
+    strengths = entry.get("強項", "")
+    weaknesses = entry.get("弱項", "")
+    suggestion = entry.get("建議", "")
 
-    for entry in analysis_results:
-        name = entry.get("姓名", "未命名")
-        scores = {
-            "聽力": entry.get("聽力", ""),
-            "口說": entry.get("口說", ""),
-            "閱讀": entry.get("閱讀", ""),
-            "寫作": entry.get("寫作", "")
-        }
-        strengths = entry.get("強項", "")
-        weaknesses = entry.get("弱項", "")
-        suggestion = entry.get("建議", "")
-
-        elements.append(Paragraph(f"<b>學生姓名：{name}</b>", styles["ChineseHeading"]))
-        elements.append(Spacer(1, 6))
+    elements.append(Paragraph(f"<b>學生姓名：{name}</b>", styles["ChineseHeading"]))
+    elements.append(Spacer(1, 6))
 
-        score_data = [["技能", "分數"]] + [[k, str(v)] for k, v in scores.items()]
-        score_table = Table(score_data, colWidths=[60, 60])
-        score_table.setStyle(TableStyle([
-            ("BACKGROUND", (0, 0), (-1, 0), colors.lightblue),
-            ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
-            ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-            ("FONTNAME", (0, 0), (-1, -1), "ChineseFont"),
-            ("FONTSIZE", (0, 0), (-1, -1), 10),
-            ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
-        ]))
-        elements.append(score_table)
-        elements.append(Spacer(1, 6))
+    score_data = [["技能", "分數"]] + [[k, str(v)] for k, v in scores.items()]
+    score_table = Table(score_data, colWidths=[60, 60])
+    score_table.setStyle(TableStyle([
+        ("BACKGROUND", (0, 0), (-1, 0), colors.lightblue),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+        ("FONTNAME", (0, 0), (-1, -1), register_chinese_font()),
+        ("FONTSIZE", (0, 0), (-1, -1), 10),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+    ]))
+    elements.append(score_table)
+    elements.append(Spacer(1, 6))
 
-        elements.append(Paragraph(f"<b>強項：</b> {strengths}", styles["Chinese"]))
-        elements.append(Paragraph(f"<b>弱項：</b> {weaknesses}", styles["Chinese"]))
-        elements.append(Spacer(1, 6))
+    elements.append(Paragraph(f"<b>強項：</b> {strengths}", styles["Chinese"]))
+    elements.append(Paragraph(f"<b>弱項：</b> {weaknesses}", styles["Chinese"]))
+    elements.append(Spacer(1, 6))
 
-        elements.append(Paragraph("<b>學習建議：</b>", styles["Chinese"]))
-        suggestion_paragraph = Paragraph(suggestion.replace("\n", "<br/>"), styles["Chinese"])
-        elements.append(suggestion_paragraph)
+    elements.append(Paragraph("<b>學習建議：</b>", styles["Chinese"]))
+    suggestion_paragraph = Paragraph(suggestion.replace("\n", "<br/>"), styles["Chinese"])
+    elements.append(suggestion_paragraph)
 
-        elements.append(Spacer(1, 18))
-        elements.append(PageBreak())
+    elements.append(Spacer(1, 18))
+    elements.append(PageBreak())
+    return elements
 
+def _render_students(job):
+    """在子行程中把一組學生輸出成一份 PDF，回傳檔案路徑（先寫暫存檔再改名，避免留下半份檔案）"""
+    entries, path = job
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    doc = SimpleDocTemplate(tmp_path, pagesize=A4)
+    elements = []
+    for entry in entries:
+        elements.extend(_student_elements(entry))
     doc.build(elements)
-    print(f"✅ 學生建議 PDF 已產出：{output_path}")
+    os.replace(tmp_path, path)
+    return path
+
+def _render_all(jobs: list, workers: int) -> list:
+    if workers > 1 and len(jobs) > 1:
+        return list(_get_render_pool().map(_render_students, jobs))
+    return [_render_students(job) for job in jobs]
+
+def _merge_pdfs(paths: list, output_path: str):
+    # 依原本順序合併各分片
+    writer = PdfWriter()
+    for path in paths:
+        writer.append(path)
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+def _student_filename(index: int, entry: dict) -> str:
+    name = re.sub(r'[\\/:*?"<>|\s]+', "_", str(entry.get("姓名", "未命名"))).strip("_") or "student"
+    return f"{index:04d}_{name}.pdf"
+
+def shard_fingerprint(entries: list) -> str:
+    """一個分片內所有學生內容（含字型）的雜湊，內容不變時可直接沿用上次輸出的分片"""
+    payload = json.dumps([{key: str(value) for key, value in entry.items()} for entry in entries],
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(f"{register_chinese_font()}\n{payload}".encode("utf-8")).hexdigest()[:32]
+
+def _evict_shards(cache_dir: str, keep: set):
+    """分片快取超過 SHARD_CACHE_MAX 份時，刪除最久未使用的分片（本次用到的不刪）"""
+    paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".pdf")]
+    if len(paths) <= SHARD_CACHE_MAX:
+        return
+    paths.sort(key=os.path.getmtime)
+    for path in paths[:len(paths) - SHARD_CACHE_MAX]:
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def generate_student_pdf(analysis_results: list, output_path: str, workers: int = None,
+                         per_student_dir: str = None, shard_cache_dir: str = None):
+    """
+    產生學生建議 PDF。
+    - workers > 1 且學生數達 PARALLEL_MIN_STUDENTS 時，以行程池分片平行輸出，再合併成一份（需安裝 pypdf）
+    - per_student_dir：另外為每位學生輸出一份獨立 PDF（此時以每位學生為單位平行輸出再合併）
+    - shard_cache_dir：學生數達 PARALLEL_MIN_STUDENTS 時，每 SHARD_SIZE 位學生為一個分片並依內容雜湊存放，
+      只重新輸出內容有變動的分片；人數較少時直接一次輸出（比合併更小也更快）
+    """
+    workers = PDF_WORKERS if workers is None else workers
+    sharded = len(analysis_results) >= PARALLEL_MIN_STUDENTS
+    parallel = (workers > 1 and sharded) or per_student_dir or (shard_cache_dir and sharded)
+    if parallel and PdfWriter is None:
+        print("⚠️ 未安裝 pypdf，無法合併分片 PDF，改為單一行程輸出")
+        parallel = False
+
+    if not parallel:
+        _render_students((analysis_results, output_path))
+        print(f"✅ 學生建議 PDF 已產出：{output_path}")
+        return
+
+    if shard_cache_dir and not per_student_dir:
+        os.makedirs(shard_cache_dir, exist_ok=True)
+        shards = [analysis_results[i:i + SHARD_SIZE] for i in range(0, len(analysis_results), SHARD_SIZE)]
+        paths = [os.path.join(shard_cache_dir, f"{shard_fingerprint(shard)}.pdf") for shard in shards]
+        pending = {}
+        for shard, path in zip(shards, paths):
+            if path not in pending and not os.path.exists(path):
+                pending[path] = (shard, path)
+        jobs = list(pending.values())
+        _render_all(jobs, workers)
+        for path in set(paths):
+            os.utime(path)  # 更新使用時間，供淘汰判斷
+        _merge_pdfs(paths, output_path)
+        _evict_shards(shard_cache_dir, set(paths))
+        print(f"✅ 學生建議 PDF 已產出（重新輸出 {len(jobs)} / {len(paths)} 個分片）：{output_path}")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if per_student_dir:
+            os.makedirs(per_student_dir, exist_ok=True)
+            jobs = [([entry], os.path.join(per_student_dir, _student_filename(i, entry)))
+                    for i, entry in enumerate(analysis_results)]
+        else:
+            shard_size = -(-len(analysis_results) // workers)
+            jobs = [(analysis_results[i:i + shard_size], os.path.join(tmp_dir, f"shard_{i:06d}.pdf"))
+                    for i in range(0, len(analysis_results), shard_size)]
+
+        paths = _render_all(jobs, workers)
+        _merge_pdfs(paths, output_path)
+
+    print(f"✅ 學生建議 PDF 已產出（{len(paths)} 份分片平行輸出）：{output_path}")
     
 def generate_student_csv(analysis_results: list, output_path: str):
     df = pd.DataFrame(analysis_results)
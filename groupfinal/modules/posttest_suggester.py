@@ -1,14 +1,18 @@
 import os
+import sys
 import pandas as pd
 from google.generativeai import GenerativeModel, configure
 from google.api_core.exceptions import GoogleAPIError
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from common.llm_client import get_llm_client
+from common.circuit_breaker import CircuitOpenError
+from modules.classifier import class_skill_profile
+
 # ✅ 初始化 Gemini API
 configure(api_key=os.getenv("GEMINI_API_KEY"))
 model = GenerativeModel("gemini-1.5-flash-8b")
 
-SKILLS = ["聽力", "口說", "閱讀", "寫作"]
-
 TEMPLATES = {
     "聽力": "建議設計基礎生活聽力理解題，例如日常對話聽寫、聽後選擇題。",
     "口說": "可安排口說互動活動，如看圖說話、情境角色扮演等。",
@@ -16,19 +20,20 @@ TEMPLATES = {
     "寫作": "建議設計短文造句、圖文寫作等實作型題目，培養表達結構。"
 }
 
-def generate_posttest_transcript(df: pd.DataFrame) -> str:
+def generate_posttest_transcript(df: pd.DataFrame, profile: pd.DataFrame = None) -> str:
     if "Class_Level" not in df.columns:
         raise ValueError("缺少 Class_Level 欄位，請先完成分班。")
 
+    # 各班統計（可與分班報告 PDF 共用），取平均最低的兩項為弱項
+    if profile is None:
+        profile = class_skill_profile(df)
     class_info = {}
-    for level in sorted(df["Class_Level"].unique()):
-        group = df[df["Class_Level"] == level]
-        avg_scores = {
-            skill: group[f"{skill}成績"].mean() for skill in SKILLS
-        }
-        sorted_skills = sorted(avg_scores.items(), key=lambda x: x[1])
-        weak_skills = [s[0] for s in sorted_skills[:2]]
-        class_info[level] = weak_skills
+    class_means = {}
+    for level, stats in profile.groupby(level="Class_Level", observed=True, sort=False):
+        means = stats["平均"].droplevel("Class_Level")
+        weakest = means.nsmallest(2)
+        class_info[level] = list(weakest.index)
+        class_means[level] = list(weakest.values)
 
     try:
         prompt_lines = [
@@ -37,14 +42,17 @@ def generate_posttest_transcript(df: pd.DataFrame) -> str:
             ""
         ]
         for level, weak_skills in class_info.items():
-            prompt_lines.append(f"【{level} 班】：弱項：{weak_skills[0]}、{weak_skills[1]}")
+            means = class_means[level]
+            prompt_lines.append(
+                f"【{level} 班】：弱項：{weak_skills[0]}（平均 {means[0]:.1f}）、{weak_skills[1]}（平均 {means[1]:.1f}）"
+            )
         prompt = "\n".join(prompt_lines)
 
-        response = model.generate_content(prompt)
+        response = get_llm_client().call(model.generate_content, prompt, label="posttest", circuit="gemini")
         suggestion = response.text.strip() if response and hasattr(response, "text") else ""
         return suggestion
 
-    except GoogleAPIError as e:
+    except (GoogleAPIError, CircuitOpenError) as e:
         print("⚠️ Gemini API 錯誤，改用模板建議。\n", str(e))
         output = ["⚠️ 因為 Gemini API 額度已滿，以下為初步建議，實際建議可重新嘗試獲取：\n"]
         for level, weak_skills in class_info.items():
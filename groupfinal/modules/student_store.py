@@ -0,0 +1,54 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from modules.classifier import SCORE_COLUMNS
+
+# 每位學生的指紋資料庫：以姓名與四項成績（加上 prompt 版本）計算雜湊，
+# 成績沒變的學生直接沿用上次產生的建議，不再呼叫 LLM
+
+def student_fingerprint(row, version: str = "") -> str:
+    payload = {"version": version, "姓名": str(row.get("姓名", ""))}
+    payload.update({col: str(row.get(col, "")) for col in SCORE_COLUMNS})
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:32]
+
+class StudentStore:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS suggestions ("
+            "fingerprint TEXT PRIMARY KEY, suggestion TEXT NOT NULL, updated_at REAL)"
+        )
+        self.conn.commit()
+
+    def get_many(self, fingerprints) -> dict:
+        """回傳 {指紋: 建議}，只包含已有紀錄的學生"""
+        found = {}
+        keys = list(dict.fromkeys(fingerprints))
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT fingerprint, suggestion FROM suggestions WHERE fingerprint IN ({','.join('?' * len(part))})",
+                    part,
+                ).fetchall()
+                found.update(rows)
+        return found
+
+    def set_many(self, items: dict):
+        if not items:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO suggestions (fingerprint, suggestion, updated_at) VALUES (?, ?, ?)",
+                [(fp, suggestion, now) for fp, suggestion in items.items()],
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
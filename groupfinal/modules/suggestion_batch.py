@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from common.llm_client import get_llm_client
+from common.json_mode import request_json_rows
+
+# 一次請求中合併的學生人數，以及批次內缺漏學生的重新請求輪數（之後才改為逐一呼叫）
+SUGGESTION_BATCH_SIZE = int(os.getenv("SUGGESTION_BATCH_SIZE", "10"))
+SUGGESTION_BATCH_ROUNDS = int(os.getenv("SUGGESTION_BATCH_ROUNDS", "2"))
+
+BATCH_INSTRUCTIONS = (
+    "\n\n以下每位學生前都有 [編號]。請只回傳一個 JSON 陣列，不要加入其他說明文字。"
+    "陣列中每個元素對應一位學生，必須包含該學生的 \"index\"（整數，與 [編號] 相同）"
+    "以及 \"建議\"（字串，該學生的完整建議內容，可用 \\n 分段）。\n"
+    "例如：\n"
+    "[{\"index\": 0, \"建議\": \"...\"}, {\"index\": 1, \"建議\": \"...\"}]\n\n"
+)
+
+def chunked(items: list, size: int = None):
+    size = max(size or SUGGESTION_BATCH_SIZE, 1)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def request_batch_suggestions(model, header: str, students: list, label: str = "batch_suggestion") -> list:
+    """
+    把多位學生合併成一次請求，要求模型以 JSON 陣列逐一回覆建議並檢查 index。
+    header：所有學生共用的說明；students：每位學生的資料文字。
+    回傳與 students 等長的 list，批次內仍缺漏的位置為 None，由呼叫端改為逐一呼叫。
+    """
+    def send(indexed_text):
+        try:
+            response = get_llm_client().call(
+                model.generate_content, header + BATCH_INSTRUCTIONS + indexed_text,
+                label=label, circuit="gemini"
+            )
+            return response.text if response and response.text else None
+        except Exception as e:
+            print(f"⚠️ 批次建議請求失敗：{e}")
+            return None
+
+    rows = request_json_rows(send, students, ["建議"], max_rounds=SUGGESTION_BATCH_ROUNDS)
+    return [row["建議"].replace("\\n", "\n") if row and row["建議"] else None for row in rows]
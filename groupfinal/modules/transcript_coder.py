@@ -0,0 +1,115 @@
+import os
+import sys
+import hashlib
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from common.response_cache import ResponseCache
+from common.batching import AdaptiveBatchSizer, code_with_split, estimate_tokens, iter_chunk_batches
+from common.json_mode import json_array_instructions
+from common.transcript_coding import TranscriptCoder
+from modules.classifier import classify_scores
+
+# second.py 與 lastone.py 共用的逐字稿編碼流程
+
+# === 設定 ===
+csv_file_path = "japanese_pretest.csv"
+jlpt_file_path = "japanese_learning_info.csv"
+chunk_size = 1000          # 串流模式下每次讀入的列數
+batch_size = 12            # 每批最多筆數（實際筆數依 token 預算決定，錯位時自動縮小）
+token_budget = int(os.getenv("CODER_TOKEN_BUDGET", "8000"))
+delimiter = "-----"
+MODEL_NAME = "models/gemini-1.5-flash-latest"
+# 回覆格式："delimiter"（以 ----- 分隔）或 "json"（單一 JSON 陣列，逐筆帶 index）
+RESPONSE_MODE = os.getenv("CODER_RESPONSE_MODE", "delimiter")
+ALLOWED_VALUES = ("Yes", "No")
+
+ITEMS = [
+]
+
+# === 回應快取設定 ===
+CACHE_PATH = os.getenv("CODER_CACHE_PATH", ".coding_cache.sqlite")
+CACHE_MAX_ENTRIES = int(os.getenv("CODER_CACHE_MAX_ENTRIES", "200000"))
+
+def open_cache():
+    return ResponseCache(CACHE_PATH, max_entries=CACHE_MAX_ENTRIES)
+
+# === 將學生分級並輸出分類結果 ===
+def classify_and_export(export_csv: bool = True):
+    """
+    合併前測與學習資訊並分級，以一次 groupby 拆出各級別的 DataFrame。
+    回傳 (merged_df, class_groups)，class_groups 為 {"Beginner": df, ...}，可直接交給編碼流程；
+    export_csv=True 時另外輸出 class_{level}.csv 供 PDF123.py 等其他腳本使用。
+    """
+    pretest_df = pd.read_csv(csv_file_path)
+    jlpt_df = pd.read_csv(jlpt_file_path)
+    merged_df = pd.merge(pretest_df, jlpt_df, on="StudentID")
+    merged_df["Class_Level"] = classify_scores(merged_df["Total_Score"])
+
+    # observed=False：即使某個級別沒有學生，也保留空的 DataFrame（與原本固定輸出三個檔案一致）
+    class_groups = {
+        str(level): group
+        for level, group in merged_df.groupby("Class_Level", observed=False, sort=True)
+    }
+
+    if export_csv:
+        for level, df in class_groups.items():
+            filename = f"class_{level.lower()}.csv"
+            df.to_csv(filename, index=False)
+
+    return merged_df, class_groups
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """以內容雜湊代表一個 DataFrame，供續跑時確認輸入沒有改變"""
+    row_hashes = pd.util.hash_pandas_object(df, index=False).values
+    return hashlib.sha256(row_hashes.tobytes() + ",".join(map(str, df.columns)).encode("utf-8")).hexdigest()
+
+# === 批次分析提示模板（同時作為快取 key 的一部分）===
+def build_prompt():
+    return (
+        "你是一位日文教學專家，請根據以下編碼規則評估是否與日語教學的目標相同：\n"
+        + "\n".join(ITEMS) +
+        "\n\n請依據評估結果，對每個項目：若觸及則標記為 Yes，否則標記為 No。"
+        "請對每筆逐字稿產生 JSON 格式回覆，並在各筆結果間用下列分隔線隔開：\n"
+        f"{delimiter}\n"
+        "例如：\n"
+        "```json\n"
+        "{ \"Vocab\": \"Yes\", \"Listening\": \"No\", ... }\n"
+        f"{delimiter}\n"
+        "{...}\n```"
+    )
+
+# === 依 token 預算打包批次 ===
+def make_sizer():
+    return AdaptiveBatchSizer(token_budget, estimate_tokens(build_prompt()), max_rows=batch_size)
+
+def iter_coded_batches(client, chunks, dialogue_col: str, sizer: AdaptiveBatchSizer,
+                       cache: ResponseCache = None, start: int = 0):
+    """
+    依序產生 (start_idx, end_idx, batch_df, batch_results)。
+    chunks 為 DataFrame 的 iterable：整個檔案可傳 [df]，串流模式傳 pd.read_csv(..., chunksize=...)。
+    筆數錯位的批次會自動拆半重送。
+    """
+    for start_idx, end_idx, batch, dialogues in iter_chunk_batches(chunks, dialogue_col, sizer, start=start):
+        if RESPONSE_MODE == "json":
+            batch_results = coder.code_batch_json(client, dialogues, cache=cache)
+        else:
+            batch_results = code_with_split(
+                lambda part, strict: coder.code_batch(client, part, cache=cache, strict=strict),
+                dialogues,
+                sizer,
+            )
+        yield start_idx, end_idx, batch, batch_results
+
+# === JSON 陣列模式：逐筆帶 index，只重送缺漏或格式錯誤的筆數 ===
+def build_json_prompt():
+    return (
+        "你是一位日文教學專家，請根據以下編碼規則評估是否與日語教學的目標相同：\n"
+        + "\n".join(ITEMS) +
+        "\n\n請依據評估結果，對每個項目：若觸及則標記為 Yes，否則標記為 No。"
+        + json_array_instructions(ITEMS, ALLOWED_VALUES)
+    )
+
+# === 批次編碼流程與 DRai 共用，只提供本專案的模型、ITEMS 與提示 ===
+coder = TranscriptCoder(MODEL_NAME, ITEMS, build_prompt(), build_json_prompt(), ALLOWED_VALUES,
+                        label="transcript_coder", delimiter=delimiter)